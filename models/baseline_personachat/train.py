@@ -1,4 +1,5 @@
 import os
+import sys
 import math
 import logging
 from pprint import pformat
@@ -17,6 +18,11 @@ from ignite.contrib.handlers.tensorboard_logger import TensorboardLogger, Output
 from pytorch_transformers import (AdamW, OpenAIGPTDoubleHeadsModel, OpenAIGPTTokenizer,
                                   GPT2DoubleHeadsModel, GPT2Tokenizer, WEIGHTS_NAME, CONFIG_NAME)
 
+# the repository root, for the helpers shared with models/reinforce_model
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from models.reinforce_model.distributed import init_distributed
+from models.reinforce_model.losses import double_heads_chunked
+from models.reinforce_model.profiling import ProfilerWindow
 from utils import get_dataset, make_logdir
 from data import get_data_loaders
 
@@ -70,7 +76,11 @@ def train():
     parser.add_argument("--eval_before_start", action='store_true', help="If true start with a first evaluation before training")
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device (cuda or cpu)")
     parser.add_argument("--fp16", type=str, default="", help="Set to O0, O1, O2 or O3 for fp16 training (see apex documentation)")
-    parser.add_argument("--local_rank", type=int, default=-1, help="Local rank for distributed training (-1: not distributed)")
+    parser.add_argument("--local_rank", type=int, default=int(os.environ.get("LOCAL_RANK", -1)), help="Local rank for distributed training (-1: not distributed, torchrun sets LOCAL_RANK)")
+    parser.add_argument("--num_threads_per_rank", type=int, default=0, help="Intra-op threads (and pinned cores) of every process in CPU distributed training (<=0: the cores split evenly)")
+    parser.add_argument("--profile_from", type=int, default=0, help="Iteration to start torch.profiler at; the trace and op tables go to the log dir (<=0: off)")
+    parser.add_argument("--profile_iterations", type=int, default=5, help="Iterations to profile from --profile_from")
+    parser.add_argument("--chunked_ce_size", type=int, default=0, help="Vocabulary entries per block of the chunked LM cross-entropy (<=0: full logits)")
     args = parser.parse_args()
 
     # logging is set to INFO (resp. WARN) for main (resp. auxiliary) process. logger.info => log main process only, logger.warning => log all processes
@@ -81,9 +91,7 @@ def train():
     # Initialize distributed training if needed
     args.distributed = (args.local_rank != -1)
     if args.distributed:
-        torch.cuda.set_device(args.local_rank)
-        args.device = torch.device("cuda", args.local_rank)
-        torch.distributed.init_process_group(backend='nccl', init_method='env://')
+        init_distributed(args)
 
     print("Prepare tokenizer, pretrained model and optimizer.")
     tokenizer_class = GPT2Tokenizer if "gpt2" in args.model_checkpoint else OpenAIGPTTokenizer # cant use Autotokenizer because checkpoint could be a Path
@@ -102,7 +110,12 @@ def train():
         from apex import amp  # Apex is only required if we use fp16 training
         model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16)
     if args.distributed:
-        model = DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank)
+        if args.chunked_ce_size > 0:
+            # the chunked loss calls the heads directly, which would bypass the gradient synchronization of DistributedDataParallel
+            raise ValueError("--chunked_ce_size is not supported with distributed training")
+        model = DistributedDataParallel(
+            model, device_ids=[args.local_rank] if args.device.type == 'cuda' else None,
+            output_device=args.local_rank if args.device.type == 'cuda' else None)
 
     print("Prepare datasets")
     train_loader, val_loader, train_sampler, valid_sampler = get_data_loaders(args, tokenizer)
@@ -114,10 +127,16 @@ def train():
         input_ids, mc_token_ids, lm_labels, mc_labels, token_type_ids = batch
         print('LM:', lm_labels)
         print('MC:', mc_labels)
-        (lm_loss), (mc_loss), *_ = model(
-            input_ids, token_type_ids=token_type_ids, mc_token_ids=mc_token_ids,
-            mc_labels=mc_labels, lm_labels=lm_labels
-        )
+        if args.chunked_ce_size > 0:
+            token_nll, mc_logits = double_heads_chunked(
+                model, input_ids, token_type_ids, mc_token_ids, lm_labels, args.chunked_ce_size)
+            lm_loss = token_nll.mean()
+            mc_loss = torch.nn.functional.cross_entropy(mc_logits.view(-1, mc_logits.size(-1)), mc_labels.view(-1))
+        else:
+            (lm_loss), (mc_loss), *_ = model(
+                input_ids, token_type_ids=token_type_ids, mc_token_ids=mc_token_ids,
+                mc_labels=mc_labels, lm_labels=lm_labels
+            )
         loss = (lm_loss * args.lm_coef + mc_loss * args.mc_coef) / args.gradient_accumulation_steps
         if args.fp16:
             with amp.scale_loss(loss, optimizer) as scaled_loss:
@@ -139,6 +158,10 @@ def train():
             batch = tuple(input_tensor.to(args.device) for input_tensor in batch)
             input_ids, mc_token_ids, lm_labels, mc_labels, token_type_ids = batch
             # print(tokenizer.decode(input_ids[0, -1, :].tolist()))
+            if args.chunked_ce_size > 0:
+                token_nll, mc_logits = double_heads_chunked(
+                    model, input_ids, token_type_ids, mc_token_ids, lm_labels, args.chunked_ce_size)
+                return (token_nll, mc_logits), (token_nll, mc_labels)
             # if we dont send labels to model, it doesnt return losses
             lm_logits, mc_logits, *_ = model(
                 input_ids, token_type_ids=token_type_ids, mc_token_ids=mc_token_ids,
@@ -166,7 +189,8 @@ def train():
 
     # Prepare metrics - note how we compute distributed metrics
     RunningAverage(output_transform=lambda x: x).attach(trainer, "loss")
-    metrics = {"nll": Loss(torch.nn.CrossEntropyLoss(ignore_index=-1), output_transform=lambda x: (x[0][0], x[1][0])),
+    nll_fn = (lambda token_nll, _: token_nll.mean()) if args.chunked_ce_size > 0 else torch.nn.CrossEntropyLoss(ignore_index=-1)
+    metrics = {"nll": Loss(nll_fn, output_transform=lambda x: (x[0][0], x[1][0])),
                "accuracy": Accuracy(output_transform=lambda x: (x[0][1], x[1][1]))}
     metrics.update({"average_nll": MetricsLambda(average_distributed_scalar, metrics["nll"], args),
                     "average_accuracy": MetricsLambda(average_distributed_scalar, metrics["accuracy"], args)})
@@ -189,6 +213,8 @@ def train():
 
         checkpoint_handler = ModelCheckpoint(log_dir, 'checkpoint', save_interval=1, n_saved=3)
         trainer.add_event_handler(Events.EPOCH_COMPLETED, checkpoint_handler, {'mymodel': getattr(model, 'module', model)})  # "getattr" takes care of distributed encapsulation
+        if args.profile_from > 0:
+            ProfilerWindow(log_dir, args.profile_from, args.profile_iterations, args.device).attach(trainer)
 
         torch.save(args, log_dir + '/model_training_args.bin')
         getattr(model, 'module', model).config.to_json_file(os.path.join(log_dir, CONFIG_NAME))
@@ -0,0 +1,32 @@
+from functools import partial
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+SUBMODULES = ['gpt2', 'prior', 'posterior']
+
+
+def _checkpointed_forward(forward, *args, **kwargs):
+    if torch.is_grad_enabled():
+        return checkpoint(forward, *args, use_reentrant=False, **kwargs)
+    return forward(*args, **kwargs)
+
+
+def checkpoint_blocks(blocks):
+    '''
+    blocks: the transformer layers of a model (e.g. GPT2's transformer.h)
+    Every block keeps only its inputs in the forward pass and recomputes its activations in the backward pass
+    (with the same dropout masks, so the loss and gradients do not change). The forward is replaced on the
+    instances, so parameter names, and hence saved checkpoints, stay the same.
+    '''
+    for block in blocks:
+        block.forward = partial(_checkpointed_forward, block.forward)
+
+
+def parse_submodules(gradient_checkpointing):
+    ''' --gradient_checkpointing "gpt2,prior" -> ['gpt2', 'prior'] '''
+    submodules = [name for name in gradient_checkpointing.split(',') if name]
+    unknown = [name for name in submodules if name not in SUBMODULES]
+    if unknown:
+        raise ValueError('Unknown --gradient_checkpointing submodules {}, choose from {}'.format(unknown, SUBMODULES))
+    return submodules
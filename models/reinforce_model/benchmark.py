@@ -0,0 +1,595 @@
+import os
+import copy
+import time
+import resource
+import socket
+import multiprocessing
+from argparse import ArgumentParser
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from ignite.engine import Engine
+from ignite.metrics import RunningAverage
+from transformers import GPT2Tokenizer, GPT2DoubleHeadsModel, GPT2LMHeadModel
+
+from models.reinforce_model.dataset import PersonaChatDataset, ATTR_TO_SPECIAL_TOKEN
+from models.reinforce_model.prior_posterior_models import PriorRobertaModel
+from models.reinforce_model.losses import chunked_cross_entropy
+from models.reinforce_model.packing import PackedBatch, packed_gpt2_hidden_states
+from models.reinforce_model.model_with_inferencenw import LatentVariableInferenceModel, load_latent_variable_model
+from models.reinforce_model.checkpointing import exported_path, is_exported
+from models.reinforce_model.activation_checkpointing import checkpoint_blocks
+from models.reinforce_model.distributed import pin_cpu_threads
+from models.reinforce_model.train import DeviceRunningAverage, autocast
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--mode", type=str, required=True, choices=["encoder", "encoder_memory", "ce", "pack", "backbone", "load", "metrics", "precision", "ddp_scaling", "grad_ckpt"], help="What to benchmark")
+    parser.add_argument("--dataset_path", type=str, default="", help="Path or url of the dataset. If empty download from S3.")
+    parser.add_argument("--dataset_cache", type=str, default='persona_comet_weak_label_preprocessed', help="Path or url of the dataset cache")
+    parser.add_argument("--num_candidates", type=int, default=1, help="Number of candidates for training")
+    parser.add_argument("--max_history", type=int, default=2, help="Number of previous exchanges to keep in history")
+    parser.add_argument("--personality_permutations", type=int, default=1, help="Number of permutations of personality sentences")
+    parser.add_argument("--num_beams", type=int, default=5, help="Number of beams for comet expansion")
+    parser.add_argument("--test_run_num", type=int, default=30, help="Dialogs to build the benchmark batches from")
+    parser.add_argument("--no_persona", action='store_true', help="No Persona Evaluation")
+    parser.add_argument("--no_comet_persona", action='store_true', help="No Persona Evaluation")
+    parser.add_argument("--uniform_prior", action='store_true', help="Uniform prior")
+    parser.add_argument("--train_batch_size", type=int, default=2, help="Batch size")
+    parser.add_argument("--num_batches", type=int, default=10, help="Number of batches to time")
+    parser.add_argument("--encoder_bucket_size", type=int, default=32, help="Rows per length-sorted bucket when encoding personas (<=0: one bucket)")
+    parser.add_argument("--chunked_ce_size", type=int, default=4096, help="Vocabulary entries per block of the chunked LM cross-entropy")
+    parser.add_argument("--pack_length", type=int, default=512, help="Tokens per packed GPT2 row")
+    parser.add_argument("--encoder_model", type=str, default="roberta-base", help="Encoder of the prior: HF name or local path with RoBERTa's vocabulary, or 'tiny'")
+    parser.add_argument("--encoder_num_layers", type=int, default=0, help="Keep only the first layers of the encoder (<=0: all)")
+    parser.add_argument("--backbones", type=str, default="roberta-base,roberta-base:6,distilroberta-base,tiny",
+                        help="Comma separated encoders to compare, each `name` or `name:num_layers`")
+    parser.add_argument("--model_checkpoint_dir", type=str, default="", help="Run directory to load a model from (mode load)")
+    parser.add_argument("--load_checkpoint_from", type=str, default="", help="Checkpoint file in model_checkpoint_dir (mode load)")
+    parser.add_argument("--log_every", type=int, default=10, help="Iterations between reading the running averages back (mode metrics)")
+    parser.add_argument("--precisions", type=str, default="", help="Comma separated --precision modes to compare (mode precision; default: fp32,fp16,bf16 on CUDA, fp32,bf16 on CPU)")
+    parser.add_argument("--world_sizes", type=str, default="1,2,4,8", help="Comma separated numbers of gloo processes to compare (mode ddp_scaling)")
+    parser.add_argument("--num_threads_per_rank", type=int, default=0, help="Threads of every process (mode ddp_scaling; <=0: the cores split evenly)")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device (cuda or cpu)")
+    return parser.parse_args()
+
+
+def load_batches(args):
+    ''' First `num_batches` training batches, as the trainer sees them '''
+    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+    tokenizer.add_special_tokens(ATTR_TO_SPECIAL_TOKEN)
+    args.vocab_size = len(tokenizer)
+    dataset = PersonaChatDataset(args, tokenizer, split='train')
+    loader = DataLoader(dataset, batch_size=args.train_batch_size, collate_fn=dataset.collate_dialog)
+    batches = []
+    for batch in loader:
+        batches.append({name: tensor.to(args.device) for name, tensor in batch.items()})
+        if len(batches) == args.num_batches:
+            break
+    return batches
+
+
+def _run(fn, device):
+    if str(device).startswith('cuda'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        start = time.time()
+        fn()
+        torch.cuda.synchronize()
+        return time.time() - start, torch.cuda.max_memory_allocated() / 2**20
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    fn()
+    elapsed = time.time() - start
+    return elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 2**10
+
+
+def measure(fn, device):
+    '''
+    Returns (seconds, peak memory in MB) of fn().
+    On CPU the peak is the growth of the max RSS, measured in a forked process so that runs do not see each other's peak.
+    '''
+    if str(device).startswith('cuda'):
+        return _run(fn, device)
+    parent_conn, child_conn = multiprocessing.get_context('fork').Pipe()
+
+    def child():
+        child_conn.send(_run(fn, device))
+
+    process = multiprocessing.get_context('fork').Process(target=child)
+    process.start()
+    result = parent_conn.recv()
+    process.join()
+    return result
+
+
+def print_table(rows, columns):
+    print(' | '.join(columns))
+    print(' | '.join('---' for _ in columns))
+    for row in rows:
+        print(' | '.join(str(row[c]) if not isinstance(row[c], float) else '{:.3f}'.format(row[c]) for c in columns))
+
+
+def benchmark_encoder(args, batches):
+    '''
+    Prior RoBERTa scoring (forward + backward) with padding attended to, masked in a single bucket,
+    and masked in length-sorted buckets. The last two must give the same distribution over z.
+    '''
+    model = PriorRobertaModel(args).to(args.device)
+    model.eval()  # no dropout, so that the variants are comparable
+
+    def score(batch, use_length):
+        return model.get_prob_z_given_H(
+            batch['persona'], batch['history'], batch['effects'],
+            batch['persona_length'] if use_length else None, batch['history_length'] if use_length else None)
+
+    max_diff = 0.0
+    with torch.no_grad():
+        for batch in batches:
+            model.encoder_bucket_size = 0
+            masked = score(batch, True)
+            model.encoder_bucket_size = args.encoder_bucket_size
+            bucketed = score(batch, True)
+            max_diff = max(max_diff, (masked - bucketed).abs().max().item())
+    print('Max |p(z|H) masked - p(z|H) bucketed| = {:.2e}'.format(max_diff))
+
+    real_tokens = sum(b['persona_length'].sum().item() + b['history_length'].sum().item() for b in batches)
+    padded_tokens = sum(b['persona'].numel() + b['history'].numel() for b in batches)
+    print('Real tokens: {} / {} ({:.1%})'.format(real_tokens, padded_tokens, real_tokens / padded_tokens))
+
+    rows = []
+    for name, use_length, bucket_size in [('padded', False, 0), ('masked', True, 0), ('bucketed', True, args.encoder_bucket_size)]:
+        def step():
+            model.encoder_bucket_size = bucket_size
+            for batch in batches:
+                torch.log(score(batch, use_length)).sum().backward()
+            model.zero_grad()
+        seconds, peak_mb = measure(step, args.device)
+        rows.append({'variant': name, 'sec/batch': seconds / len(batches), 'peak MB': peak_mb})
+    for row in rows:
+        row['speedup'] = rows[0]['sec/batch'] / row['sec/batch']
+    print_table(rows, ['variant', 'sec/batch', 'peak MB', 'speedup'])
+
+
+class HiddenStatesEncoder(nn.Module):
+    ''' The previous encoder path: full classification forward with all hidden states, of which only the last <s> is used '''
+
+    def __init__(self, roberta_model):
+        super().__init__()
+        self.roberta_model = roberta_model
+        self.config = roberta_model.config
+
+    def base_model(self, input_ids, attention_mask=None):
+        return (self.roberta_model(input_ids, attention_mask=attention_mask, output_hidden_states=True)[1][-1],)
+
+
+def benchmark_encoder_memory(args, batches):
+    '''
+    Peak memory of prior RoBERTa scoring when all hidden states and the classification head are computed,
+    against the final-layer <s> path. Inference (no_grad) and training (forward + backward) are both reported.
+    '''
+    model = PriorRobertaModel(args).to(args.device)
+    model.eval()
+    final_layer_encoder = model.roberta_model
+    hidden_states_encoder = HiddenStatesEncoder(final_layer_encoder)
+
+    def score(batch):
+        return model.get_prob_z_given_H(
+            batch['persona'], batch['history'], batch['effects'], batch['persona_length'], batch['history_length'])
+
+    rows = []
+    for name, encoder in [('hidden_states', hidden_states_encoder), ('final_layer_cls', final_layer_encoder)]:
+        def inference():
+            model.roberta_model = encoder
+            with torch.no_grad():
+                for batch in batches:
+                    score(batch)
+
+        def training():
+            model.roberta_model = encoder
+            for batch in batches:
+                torch.log(score(batch)).sum().backward()
+            model.zero_grad()
+
+        inference_seconds, inference_mb = measure(inference, args.device)
+        training_seconds, training_mb = measure(training, args.device)
+        rows.append({'encoder': name, 'no_grad peak MB': inference_mb, 'no_grad sec/batch': inference_seconds / len(batches),
+                     'train peak MB': training_mb, 'train sec/batch': training_seconds / len(batches)})
+    model.roberta_model = final_layer_encoder
+    print_table(rows, ['encoder', 'no_grad peak MB', 'no_grad sec/batch', 'train peak MB', 'train sec/batch'])
+
+
+def benchmark_ce(args, batches):
+    '''
+    Peak memory of the LM loss (forward + backward) over the labelled reply tokens of every persona, with the
+    full-vocabulary logits against the chunked cross-entropy. The hidden states and the tied LM head have
+    GPT2-small sizes; the token counts and labels are the real ones.
+    '''
+    hidden_size = 768
+    vocab_size = args.vocab_size
+    weight = nn.Parameter(torch.randn(vocab_size, hidden_size, device=args.device) * 0.02)
+    labels = [b['lm_labels'][..., 1:][b['lm_labels'][..., 1:] != -100] for b in batches]
+    hidden_states = [torch.randn(len(l), hidden_size, device=args.device, requires_grad=True) for l in labels]
+
+    full = lambda h, l: torch.nn.functional.cross_entropy(h @ weight.T, l, reduction='none')
+    chunked = lambda h, l: chunked_cross_entropy(h, weight, l, args.chunked_ce_size)
+    max_diff = max((full(h, l) - chunked(h, l)).abs().max().item() for h, l in zip(hidden_states, labels))
+    print('Labelled tokens per batch: {:.0f}, V = {}'.format(sum(len(l) for l in labels) / len(labels), vocab_size))
+    print('Max |nll full - nll chunked| = {:.2e}'.format(max_diff))
+
+    rows = []
+    for name, loss_fn in [('full_logits', full), ('chunked_{}'.format(args.chunked_ce_size), chunked)]:
+        def step():
+            for h, l in zip(hidden_states, labels):
+                loss_fn(h, l).mean().backward()
+        seconds, peak_mb = measure(step, args.device)
+        rows.append({'loss': name, 'sec/batch': seconds / len(batches), 'peak MB': peak_mb})
+    print_table(rows, ['loss', 'sec/batch', 'peak MB'])
+
+
+def benchmark_pack(args, batches):
+    '''
+    Token utilization (real tokens / tokens through GPT2) of the persona-folded training sequences, padded to the
+    longest one against packed into rows of `pack_length`, and the time of a GPT2 forward + backward over both.
+    '''
+    model = GPT2DoubleHeadsModel.from_pretrained('gpt2')
+    model.resize_token_embeddings(args.vocab_size)
+    model.to(args.device)
+    model.eval()  # no dropout, so that the variants are comparable
+
+    padded_inputs = [(b['input_ids'].view(-1, b['input_ids'].shape[-1]), b['token_type_ids'].view(-1, b['input_ids'].shape[-1]))
+                     for b in batches]
+    packed_batches = [PackedBatch(b['mc_token_ids'].view(-1) + 1, args.pack_length) for b in batches]
+    real_tokens = sum(packed.seq_index.numel() for packed in packed_batches)
+
+    def padded():
+        for input_ids, token_type_ids in padded_inputs:
+            model.transformer(input_ids, token_type_ids=token_type_ids)[0].sum().backward()
+        model.zero_grad()
+
+    def packed():
+        for packed_batch, (input_ids, token_type_ids) in zip(packed_batches, padded_inputs):
+            packed_gpt2_hidden_states(
+                model.transformer, packed_batch, packed_batch.pack(input_ids, 0), packed_batch.pack(token_type_ids, 0)).sum().backward()
+        model.zero_grad()
+
+    rows = []
+    for name, step, tokens in [('padded', padded, sum(input_ids.numel() for input_ids, _ in padded_inputs)),
+                               ('packed_{}'.format(args.pack_length), packed,
+                                sum(p.num_rows * p.row_length for p in packed_batches))]:
+        seconds, peak_mb = measure(step, args.device)
+        rows.append({'layout': name, 'utilization': real_tokens / tokens, 'sec/batch': seconds / len(batches), 'peak MB': peak_mb})
+    print_table(rows, ['layout', 'utilization', 'sec/batch', 'peak MB'])
+
+
+def benchmark_backbone(args, batches):
+    '''
+    Prior scoring (forward + backward) and its peak memory for every encoder backbone in `backbones`
+    '''
+    def score(model, batch):
+        return model.get_prob_z_given_H(
+            batch['persona'], batch['history'], batch['effects'], batch['persona_length'], batch['history_length'])
+
+    rows = []
+    for backbone in args.backbones.split(','):
+        name, _, num_layers = backbone.partition(':')
+        args.encoder_model, args.encoder_num_layers = name, int(num_layers or 0)
+        model = PriorRobertaModel(args).to(args.device)
+        model.eval()  # no dropout, so that the backbones are comparable
+
+        def step():
+            for batch in batches:
+                torch.log(score(model, batch)).sum().backward()
+            model.zero_grad()
+        seconds, peak_mb = measure(step, args.device)
+        config = model.roberta_model.config
+        rows.append({'backbone': backbone, 'layers': config.num_hidden_layers, 'hidden': config.hidden_size,
+                     'params (M)': sum(p.numel() for p in model.parameters()) / 1e6,
+                     'sec/batch': seconds / len(batches), 'peak MB': peak_mb})
+        del model
+    print_table(rows, ['backbone', 'layers', 'hidden', 'params (M)', 'sec/batch', 'peak MB'])
+
+
+def benchmark_load(args):
+    '''
+    Startup time and peak memory of loading a trained model for generation: building it with pretrained
+    weights and then overwriting them with the checkpoint, against the config-only factory (with the pickled
+    checkpoint and, if it was exported, the memory-mapped one).
+    '''
+    training_args = torch.load(os.path.join(args.model_checkpoint_dir, 'model_training_args.bin'))
+    checkpoint_path = os.path.join(args.model_checkpoint_dir, args.load_checkpoint_from)
+    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+    tokenizer.add_special_tokens(ATTR_TO_SPECIAL_TOKEN)
+
+    def pretrained_then_checkpoint():
+        model = LatentVariableInferenceModel(training_args, generator_class=GPT2LMHeadModel)
+        model.gpt2_model.resize_token_embeddings(new_num_tokens=len(tokenizer))
+        model.load_state_dict(torch.load(checkpoint_path, map_location=lambda storage, loc: storage), strict=False)
+        model.to(args.device)
+
+    def factory(path):
+        load_latent_variable_model(training_args, GPT2LMHeadModel, path, len(tokenizer), device=args.device)
+
+    loads = [('pretrained + checkpoint', pretrained_then_checkpoint),
+             ('config + checkpoint', lambda: factory(checkpoint_path))]
+    if is_exported(exported_path(checkpoint_path)):
+        loads.append(('config + exported', lambda: factory(exported_path(checkpoint_path))))
+    rows = []
+    for name, load in loads:
+        seconds, peak_mb = measure(load, args.device)
+        rows.append({'load': name, 'sec': seconds, 'peak MB': peak_mb})
+    print_table(rows, ['load', 'sec', 'peak MB'])
+
+
+def benchmark_metrics(args, batches):
+    '''
+    Iterations per second of a GPT2 training step that reports nine running averages like the trainer, reading every
+    loss back with .item() at every iteration against averaging them on the device (read back every `log_every`).
+    '''
+    model = GPT2DoubleHeadsModel.from_pretrained('gpt2')
+    model.resize_token_embeddings(args.vocab_size)
+    model.to(args.device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+    names = ['loss_{}'.format(i) for i in range(9)]
+
+    def step(engine, batch):
+        input_ids = batch['input_ids'].view(-1, batch['input_ids'].shape[-1])
+        lm_loss = model(input_ids, token_type_ids=batch['token_type_ids'].view(-1, input_ids.shape[-1]),
+                        labels=batch['lm_labels'].view(-1, input_ids.shape[-1]))[0]
+        lm_loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        return tuple(lm_loss.detach() * i for i in range(len(names)))
+
+    def host_averages():
+        engine = Engine(lambda engine, batch: tuple(loss.item() for loss in step(engine, batch)))
+        for i, name in enumerate(names):
+            RunningAverage(output_transform=lambda x, i=i: x[i]).attach(engine, name)
+        engine.run(batches)
+
+    def device_averages():
+        engine = Engine(step)
+        DeviceRunningAverage(names, log_every=args.log_every).attach(engine)
+        engine.run(batches)
+
+    step(None, batches[0])  # warm up
+    rows = []
+    for name, fn in [('.item() every iteration', host_averages), ('device, read every {}'.format(args.log_every), device_averages)]:
+        seconds, _ = measure(fn, args.device)
+        rows.append({'averages': name, 'it/s': len(batches) / seconds})
+    print_table(rows, ['averages', 'it/s'])
+
+
+def reinforce_step_loss(prior, gpt2, batch):
+    '''
+    Loss of a REINFORCE training step: RoBERTa prior, GPT2 log-likelihood of every persona, and the
+    score-function loss of the most likely persona
+    '''
+    prob_z = prior.get_prob_z_given_H(
+        batch['persona'], batch['history'], batch['effects'], batch['persona_length'], batch['history_length'])  # B x P
+    input_ids = batch['input_ids'][:, :, 0]  # B x P x T
+    logits = gpt2(input_ids.reshape(-1, input_ids.shape[-1]),
+                  token_type_ids=batch['token_type_ids'][:, :, 0].reshape(-1, input_ids.shape[-1]))[0]
+    labels = batch['lm_labels'][:, :, 0, 1:].reshape(-1)
+    nll = torch.nn.functional.cross_entropy(
+        logits[:, :-1].float().reshape(-1, logits.shape[-1]), labels, ignore_index=-100, reduction='none')
+    ll = -nll.view(input_ids.shape[0], input_ids.shape[1], -1).sum(-1)  # B x P
+    z = prob_z.argmax(-1, keepdim=True)
+    ll_z, log_prob_z = ll.gather(1, z), torch.log(prob_z.gather(1, z))
+    return (-ll_z - log_prob_z * ll_z.detach()).mean()
+
+
+def benchmark_precision(args, batches):
+    '''
+    Throughput and peak memory of a REINFORCE training step (see reinforce_step_loss) under each autocast
+    precision, and how far its loss is from fp32.
+    '''
+    prior = PriorRobertaModel(args).to(args.device)
+    gpt2 = GPT2DoubleHeadsModel.from_pretrained('gpt2')
+    gpt2.resize_token_embeddings(args.vocab_size)
+    gpt2.to(args.device)
+    prior.eval()  # no dropout, so that the losses are comparable
+    gpt2.eval()
+    real_tokens = sum((b['mc_token_ids'] + 1).sum().item() for b in batches)
+
+    def loss_fn(batch, precision):
+        with autocast(precision, args.device):
+            return reinforce_step_loss(prior, gpt2, batch)
+
+    precisions = args.precisions.split(',') if args.precisions else \
+        (['fp32', 'fp16', 'bf16'] if str(args.device).startswith('cuda') else ['fp32', 'bf16'])
+    with torch.no_grad():
+        fp32_losses = [loss_fn(batch, 'fp32').item() for batch in batches]
+    rows = []
+    for precision in precisions:
+        scaler = torch.cuda.amp.GradScaler(enabled=precision == 'fp16')
+
+        def step():
+            for batch in batches:
+                scaler.scale(loss_fn(batch, precision)).backward()
+            prior.zero_grad()
+            gpt2.zero_grad()
+        with torch.no_grad():
+            max_diff = max(abs(loss_fn(batch, precision).item() - fp32_loss) for batch, fp32_loss in zip(batches, fp32_losses))
+        step()  # warm up
+        seconds, peak_mb = measure(step, args.device)
+        rows.append({'precision': precision, 'tokens/s': real_tokens / seconds, 'peak MB': peak_mb, 'max |loss - fp32|': max_diff})
+    print_table(rows, ['precision', 'tokens/s', 'peak MB', 'max |loss - fp32|'])
+
+
+def benchmark_grad_ckpt(args, batches):
+    '''
+    Peak memory and time of a REINFORCE training step (see reinforce_step_loss) with the transformer blocks of
+    GPT2 and/or of the RoBERTa prior recomputed in the backward pass, and the loss difference to no recomputation
+    (dropout on: the recomputed blocks replay the same masks).
+    '''
+    base_prior = PriorRobertaModel(args)
+    base_gpt2 = GPT2DoubleHeadsModel.from_pretrained('gpt2')
+    base_gpt2.resize_token_embeddings(args.vocab_size)
+    real_tokens = sum((b['mc_token_ids'] + 1).sum().item() for b in batches)
+
+    rows, reference_losses = [], None
+    for submodules in [[], ['gpt2'], ['prior'], ['gpt2', 'prior']]:
+        prior, gpt2 = copy.deepcopy(base_prior).to(args.device), copy.deepcopy(base_gpt2).to(args.device)
+        if 'gpt2' in submodules:
+            checkpoint_blocks(gpt2.transformer.h)
+        if 'prior' in submodules:
+            checkpoint_blocks(prior.roberta_model.base_model.encoder.layer)
+        prior.train()
+        gpt2.train()
+
+        def step(losses=None):
+            for i, batch in enumerate(batches):
+                torch.manual_seed(i)
+                loss = reinforce_step_loss(prior, gpt2, batch)
+                loss.backward()
+                if losses is not None:
+                    losses.append(loss.item())
+            prior.zero_grad()
+            gpt2.zero_grad()
+        losses = []
+        step(losses)  # warm up
+        reference_losses = reference_losses or losses
+        seconds, peak_mb = measure(step, args.device)
+        rows.append({'recomputed': ','.join(submodules) or 'none', 'peak MB': peak_mb, 'tokens/s': real_tokens / seconds,
+                     'max |loss - none|': max(abs(a - b) for a, b in zip(losses, reference_losses))})
+        del prior, gpt2
+    print_table(rows, ['recomputed', 'peak MB', 'tokens/s', 'max |loss - none|'])
+
+
+def _ddp_worker(rank, world_size, port, args, batches, results):
+    ''' one gloo process of benchmark_ddp_scaling: GPT2 training steps over all the batches '''
+    os.environ.update(MASTER_ADDR='127.0.0.1', MASTER_PORT=str(port), LOCAL_WORLD_SIZE=str(world_size))
+    pin_cpu_threads(rank, args.num_threads_per_rank)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+    torch.manual_seed(0)
+    model = GPT2DoubleHeadsModel.from_pretrained('gpt2')
+    model.resize_token_embeddings(args.vocab_size)
+    model.multiple_choice_head.requires_grad_(False)  # only the LM loss is trained, as in LatentVariableInferenceModel
+    model = DistributedDataParallel(model)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.0)
+
+    def step(batch):
+        input_ids = batch['input_ids'].view(-1, batch['input_ids'].shape[-1])
+        loss = model(input_ids, token_type_ids=batch['token_type_ids'].view(-1, input_ids.shape[-1]),
+                     labels=batch['lm_labels'].view(-1, input_ids.shape[-1]))[0]
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+
+    step(batches[0])  # warm up
+    dist.barrier()
+    start = time.time()
+    for batch in batches:
+        step(batch)
+    dist.barrier()
+    if rank == 0:
+        results.put(time.time() - start)
+    dist.destroy_process_group()
+
+
+def benchmark_ddp_scaling(args, batches):
+    '''
+    Weak scaling of CPU data-parallel training with gloo: every process runs GPT2 training steps over the same
+    batches, pinned to its share of the cores, with the gradients all-reduced at every step.
+    '''
+    batches = [{name: tensor.cpu() for name, tensor in batch.items()} for batch in batches]
+    sequences = sum(b['input_ids'].shape[0] * b['input_ids'].shape[1] * b['input_ids'].shape[2] for b in batches)
+    context = multiprocessing.get_context('fork')
+    rows = []
+    for world_size in [int(n) for n in args.world_sizes.split(',')]:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        results = context.Queue()
+        processes = [context.Process(target=_ddp_worker, args=(rank, world_size, port, args, batches, results))
+                     for rank in range(world_size)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        if any(process.exitcode != 0 for process in processes):
+            raise RuntimeError('A process of the {}-process run failed'.format(world_size))
+        seconds = results.get()
+        rows.append({'processes': world_size, 'sequences/s': world_size * sequences / seconds})
+    for row in rows:
+        row['speedup'] = row['sequences/s'] / rows[0]['sequences/s']
+        row['efficiency'] = row['speedup'] * rows[0]['processes'] / row['processes']
+    print_table(rows, ['processes', 'sequences/s', 'speedup', 'efficiency'])
+
+
+def run():
+    args = get_args()
+    if args.mode == 'load':
+        benchmark_load(args)
+        return
+    batches = load_batches(args)
+    print('Benchmarking {} on {} batches of size {}'.format(args.mode, len(batches), args.train_batch_size))
+    if args.mode == 'encoder':
+        benchmark_encoder(args, batches)
+    elif args.mode == 'encoder_memory':
+        benchmark_encoder_memory(args, batches)
+    elif args.mode == 'ce':
+        benchmark_ce(args, batches)
+    elif args.mode == 'pack':
+        benchmark_pack(args, batches)
+    elif args.mode == 'backbone':
+        benchmark_backbone(args, batches)
+    elif args.mode == 'metrics':
+        benchmark_metrics(args, batches)
+    elif args.mode == 'precision':
+        benchmark_precision(args, batches)
+    elif args.mode == 'ddp_scaling':
+        benchmark_ddp_scaling(args, batches)
+    elif args.mode == 'grad_ckpt':
+        benchmark_grad_ckpt(args, batches)
+
+
+if __name__ == "__main__":
+    run()
+
+'''
+Persona encoding on COMET batches:
+
+python3 -m models.reinforce_model.benchmark --mode encoder --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10
+
+Peak memory of the encoder paths:
+
+python3 -m models.reinforce_model.benchmark --mode encoder_memory --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10
+
+Peak memory of the LM cross-entropy, full logits against vocabulary chunks:
+
+python3 -m models.reinforce_model.benchmark --mode ce --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10 --chunked_ce_size 4096
+
+Token utilization of padded against packed GPT2 rows:
+
+python3 -m models.reinforce_model.benchmark --mode pack --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10 --pack_length 512
+
+Step time and memory of the prior per encoder backbone:
+
+python3 -m models.reinforce_model.benchmark --mode backbone --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10 --backbones roberta-base,roberta-base:6,distilroberta-base,tiny
+
+Training iterations per second with the running averages kept on the device:
+
+python3 -m models.reinforce_model.benchmark --mode metrics --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 100 --log_every 10
+
+Throughput, peak memory and loss error of a training step per autocast precision:
+
+python3 -m models.reinforce_model.benchmark --mode precision --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10
+
+CPU data-parallel (gloo) scaling with 1, 2, 4 and 8 processes:
+
+python3 -m models.reinforce_model.benchmark --mode ddp_scaling --device cpu --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=2 --num_batches 10 --world_sizes 1,2,4,8
+
+Memory / throughput tradeoff of recomputing the GPT2 and RoBERTa blocks (--gradient_checkpointing):
+
+python3 -m models.reinforce_model.benchmark --mode grad_ckpt --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --train_batch_size=8 --num_batches 10
+
+Startup time and peak memory of loading a trained model:
+
+python3 -m models.reinforce_model.benchmark --mode load --model_checkpoint_dir=models/reinforce_model/runs/RUN_DIR --load_checkpoint_from=checkpoint_mymodel_130408.pth
+'''
@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import zlib
+from argparse import ArgumentParser
+
+import numpy as np
+import torch
+
+INDEX_FILE = 'index.json'
+CHECKPOINT_MODES = ['full', 'trainable', 'delta']
+BASE_FIELDS = ['generation_model', 'encoder_model', 'encoder_num_layers', 'model_checkpoint']
+_BITS_DTYPES = {1: torch.uint8, 2: torch.int16, 4: torch.int32, 8: torch.int64}
+
+
+def exported_path(checkpoint_path):
+    ''' checkpoint_mymodel_130408.pth is exported to the directory checkpoint_mymodel_130408/ next to it '''
+    return os.path.splitext(checkpoint_path)[0]
+
+
+def is_exported(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, INDEX_FILE))
+
+
+def export_checkpoint(model_weights, export_path, base=None):
+    '''
+    Writes a state dict as one safetensors file per submodule (gpt2_model, prior_model, inference_model, ...),
+    which are memory-mapped when loaded. Tied tensors (e.g. the GPT2 LM head and input embeddings) are stored once,
+    the other names are recorded as aliases in index.json.
+    base: the base reference of a trainable / delta checkpoint (see base_reference), kept in index.json
+    '''
+    from safetensors.torch import save_file
+
+    os.makedirs(export_path, exist_ok=True)
+    weight_map, aliases, stored = {}, {}, {}
+    groups = {}
+    for name, weight in model_weights.items():
+        key = (weight.data_ptr(), weight.dtype, tuple(weight.shape), weight.stride())
+        if key in stored:
+            aliases[name] = stored[key]
+            continue
+        stored[key] = name
+        file_name = name.split('.')[0] + '.safetensors'
+        weight_map[name] = file_name
+        groups.setdefault(file_name, {})[name] = weight.detach().cpu().contiguous()
+    for file_name, tensors in groups.items():
+        save_file(tensors, os.path.join(export_path, file_name))
+    with open(os.path.join(export_path, INDEX_FILE), 'w') as f:
+        json.dump({'weight_map': weight_map, 'aliases': aliases, 'base': base}, f, indent=1)
+
+
+def exported_base(export_path):
+    ''' the base reference of an exported trainable / delta checkpoint, None for a full one '''
+    with open(os.path.join(export_path, INDEX_FILE)) as f:
+        return json.load(f).get('base')
+
+
+def load_exported_weights(model, export_path, device='cpu'):
+    '''
+    Copies an exported checkpoint into the parameters of model, which is already on device. The files are
+    memory-mapped and read one tensor at a time, straight onto device, so no full copy of the weights is held.
+    returns the names of the model's weights that are not in the checkpoint
+    '''
+    from safetensors import safe_open
+
+    with open(os.path.join(export_path, INDEX_FILE)) as f:
+        index = json.load(f)
+    model_weights = model.state_dict()
+    with torch.no_grad():
+        for file_name in sorted(set(index['weight_map'].values())):
+            with safe_open(os.path.join(export_path, file_name), framework='pt', device=str(device)) as f:
+                for name in f.keys():
+                    if name not in model_weights:
+                        continue
+                    weight = f.get_tensor(name)
+                    if weight.shape != model_weights[name].shape:
+                        raise RuntimeError('size mismatch for {}: {} in the checkpoint, {} in the model'.format(
+                            name, tuple(weight.shape), tuple(model_weights[name].shape)))
+                    model_weights[name].copy_(weight)
+        for alias, name in index['aliases'].items():
+            if alias in model_weights and name in model_weights and \
+                    model_weights[alias].data_ptr() != model_weights[name].data_ptr():
+                model_weights[alias].copy_(model_weights[name])
+    loaded = set(index['weight_map']) | set(index['aliases'])
+    return [name for name in model_weights if name not in loaded]
+
+
+def _bits(weight):
+    ''' the raw bits of weight as a flat integer tensor of the same element size '''
+    return weight.contiguous().view(-1).view(_BITS_DTYPES[weight.element_size()])
+
+
+def encode_delta(weight, previous):
+    '''
+    XOR of the bits of weight and of its previous value, in byte planes (all first bytes, all second bytes, ...),
+    zlib-compressed. The sign, the exponent and the high mantissa bits of a weight rarely change between two
+    checkpoints, so their planes are almost all zeros.
+    '''
+    delta = (_bits(weight) ^ _bits(previous)).view(torch.uint8).view(-1, weight.element_size()).t().contiguous()
+    return {'shape': tuple(weight.shape), 'dtype': weight.dtype, 'xor': zlib.compress(delta.numpy().tobytes(), 1)}
+
+
+def decode_delta(encoded, previous):
+    delta = torch.from_numpy(np.frombuffer(zlib.decompress(encoded['xor']), dtype=np.uint8).copy())
+    delta = delta.view(previous.element_size(), -1).t().contiguous().view(-1).view(_BITS_DTYPES[previous.element_size()])
+    return (_bits(previous) ^ delta).view(encoded['dtype']).view(encoded['shape'])
+
+
+def base_reference(args):
+    ''' what a trainable / delta checkpoint is applied to: the pretrained models (and initial weights) of the run '''
+    return {field: getattr(args, field, None) for field in BASE_FIELDS}
+
+
+class PartialCheckpoint:
+    '''
+    Epoch checkpoints of the trainable parameters only, with a reference to the base weights that the frozen ones
+    still have (load_latent_variable_model rebuilds the model from it). mode 'delta' stores every checkpoint after
+    the first as encode_delta() against the previous one, which it names, so loading follows the chain back.
+    Replaces ignite's ModelCheckpoint for --checkpoint_mode trainable / delta, and like it lists the saved
+    files in _saved as (epoch, file name).
+    '''
+
+    def __init__(self, dirname, filename_prefix, mode, base):
+        self.dirname = dirname
+        self.filename_prefix = filename_prefix
+        self.mode = mode
+        self.base = base
+        self._saved = []
+        self._previous = None  # (file name, weights) of the last checkpoint, for mode 'delta'
+
+    def __call__(self, engine, model):
+        start = time.time()
+        weights = {name: parameter.detach().to('cpu', copy=True)
+                   for name, parameter in model.named_parameters() if parameter.requires_grad}
+        checkpoint = {'checkpoint_mode': self.mode, 'base': self.base, 'previous': None, 'weights': weights}
+        if self.mode == 'delta' and self._previous is not None:
+            previous_file, previous_weights = self._previous
+            checkpoint['previous'] = previous_file
+            checkpoint['weights'] = {name: encode_delta(weight, previous_weights[name])
+                                     if name in previous_weights and previous_weights[name].shape == weight.shape
+                                     and previous_weights[name].dtype == weight.dtype else weight
+                                     for name, weight in weights.items()}
+        file_name = '{}_{}.pth'.format(self.filename_prefix, engine.state.epoch)
+        path = os.path.join(self.dirname, file_name)
+        torch.save(checkpoint, path)
+        self._saved.append((engine.state.epoch, file_name))
+        if self.mode == 'delta':
+            self._previous = (file_name, weights)
+        print('Saved {} ({}, {:.1f} MB) in {:.1f}s'.format(path, self.mode, os.path.getsize(path) / 2**20, time.time() - start))
+
+
+def read_checkpoint(checkpoint_path):
+    '''
+    returns the weights in a pickled checkpoint and, for a trainable / delta checkpoint, the reference to the base
+    weights it applies to (None for a full state dict). Delta checkpoints are resolved through the checkpoints
+    before them, which are looked up in the same directory.
+    '''
+    checkpoint = torch.load(checkpoint_path, map_location=lambda storage, loc: storage)
+    if 'checkpoint_mode' not in checkpoint:
+        return checkpoint, None
+    weights = checkpoint['weights']
+    if checkpoint['previous'] is not None:
+        previous_weights, _ = read_checkpoint(os.path.join(os.path.dirname(checkpoint_path), checkpoint['previous']))
+        weights = {name: decode_delta(weight, previous_weights[name]) if isinstance(weight, dict) else weight
+                   for name, weight in weights.items()}
+    return weights, checkpoint['base']
+
+
+def load_model_weights(model, checkpoint_path, device='cpu', model_weights=None):
+    '''
+    Loads an exported checkpoint directory or a pickled checkpoint_mymodel_*.pth into model (on device)
+    model_weights: the weights of the pickled checkpoint if already read with read_checkpoint
+    returns the names of the model's weights that are not in the checkpoint
+    '''
+    if is_exported(checkpoint_path):
+        return load_exported_weights(model, checkpoint_path, device)
+    if model_weights is None:
+        model_weights, _ = read_checkpoint(checkpoint_path)
+    missing_keys, _ = model.load_state_dict(model_weights, strict=False)
+    return missing_keys
+
+
+def export():
+    parser = ArgumentParser()
+    parser.add_argument("--model_checkpoint_dir", type=str, required=True, help="Run directory of the model")
+    parser.add_argument("--load_checkpoint_from", type=str, required=True, help="Pickled checkpoint in model_checkpoint_dir to export")
+    args = parser.parse_args()
+
+    checkpoint_path = os.path.join(args.model_checkpoint_dir, args.load_checkpoint_from)
+    model_weights, base = read_checkpoint(checkpoint_path)
+    export_path = exported_path(checkpoint_path)
+    export_checkpoint(model_weights, export_path, base)
+    print('Exported {} to {}'.format(checkpoint_path, export_path))
+
+
+if __name__ == "__main__":
+    export()
+
+'''
+Export a checkpoint once, then pass the exported directory to generate.py / interact.py:
+
+python3 -m models.reinforce_model.checkpointing --model_checkpoint_dir=models/reinforce_model/runs/RUN_DIR --load_checkpoint_from=checkpoint_mymodel_130408.pth
+
+python3 -m models.reinforce_model.interact --model_checkpoint_dir=models/reinforce_model/runs/RUN_DIR --load_checkpoint_from=checkpoint_mymodel_130408 ...
+'''
@@ -196,6 +196,9 @@ class PersonaChatDataset(Dataset):
                 padded_batch[name] = torch.LongTensor([sample[name] for sample in batch])
             else:
                 assert False, f"Unexpected batch element with key '{name}'"
+        # number of real tokens, so that the encoders can skip the padding
+        padded_batch['persona_length'] = torch.LongTensor([[len(p) for p in sample['persona']] for sample in batch])
+        padded_batch['history_length'] = torch.LongTensor([len(sample['history']) for sample in batch])
         # print("PersonaChatDataset.collate_dialog:")
         # for k, v in padded_batch.items():
         #     print(f"{k}.shape:", v.shape)
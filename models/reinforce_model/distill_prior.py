@@ -0,0 +1,182 @@
+import os
+import copy
+import time
+from pprint import pformat
+from argparse import ArgumentParser
+from functools import partial
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler
+from tqdm import tqdm
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+from models.reinforce_model.utils import make_logdir
+from models.reinforce_model.dataset import PersonaChatDataset, ATTR_TO_SPECIAL_TOKEN
+from models.reinforce_model.model_with_inferencenw import load_latent_variable_model
+from models.reinforce_model.prior_posterior_models import PriorBoWModel
+
+
+def get_args():
+    parser = ArgumentParser()
+    parser.add_argument("--dataset_path", type=str, default="", help="Path or url of the dataset. If empty download from S3.")
+    parser.add_argument("--dataset_cache", type=str, default='persona_comet_weak_label_preprocessed', help="Path or url of the dataset cache")
+    parser.add_argument("--model_checkpoint_dir", type=str, required=True, help="Run directory of the teacher (a model trained with --prior_model roberta)")
+    parser.add_argument("--load_checkpoint_from", type=str, required=True, help="Checkpoint file of the teacher in model_checkpoint_dir")
+    parser.add_argument("--num_candidates", type=int, default=1, help="Number of candidates for training")
+    parser.add_argument("--max_history", type=int, default=2, help="Number of previous exchanges to keep in history")
+    parser.add_argument("--personality_permutations", type=int, default=1, help="Number of permutations of personality sentences")
+    parser.add_argument("--num_beams", type=int, default=5, help="Number of beams for comet expansion")
+    parser.add_argument("--test_run_num", type=int, default=-1, help="Datapoints to run with in a test run")
+    parser.add_argument("--no_persona", action='store_true', help="No Persona Evaluation")
+    parser.add_argument("--no_comet_persona", action='store_true', help="No Persona Evaluation")
+    parser.add_argument("--train_batch_size", type=int, default=4, help="Batch size for training")
+    parser.add_argument("--valid_batch_size", type=int, default=4, help="Batch size for validation")
+    parser.add_argument("--lr", type=float, default=1e-4, help="Learning rate")
+    parser.add_argument("--n_epochs", type=int, default=1, help="Number of distillation epochs")
+    parser.add_argument("--use_structured_prior", action='store_true', default=False, help="Use effect type as feature in the student")
+    parser.add_argument("--use_structured_prior_binarypotential", action='store_true', default=False, help="")
+    parser.add_argument("--effect_emb_dim", type=int, default=6, help="Embedding type while computing effect feature")
+    parser.add_argument("--num_speed_batches", type=int, default=20, help="Validation batches to time the teacher and the student on")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device (cuda or cpu)")
+    parser.add_argument("--log_dir", type=str, default="", required=True, help="Provide a log dir")
+    parser.add_argument("--exp_name", type=str, default="", required=True, help="Provide an experiment name")
+    return parser.parse_args()
+
+
+def load_teacher(args, num_tokens):
+    '''
+    The RoBERTa prior of a trained LatentVariableInferenceModel, its training args and the weights of the whole
+    model. The checkpoint can be in any format load_latent_variable_model reads (full, trainable, delta, exported).
+    num_tokens: vocabulary size of the model's GPT2 (with the special tokens)
+    '''
+    training_args = torch.load(os.path.join(args.model_checkpoint_dir, 'model_training_args.bin'))
+    assert training_args.prior_model == 'roberta', 'The teacher must be trained with --prior_model roberta'
+    model = load_latent_variable_model(
+        training_args, GPT2LMHeadModel, os.path.join(args.model_checkpoint_dir, args.load_checkpoint_from), num_tokens)
+    teacher = model.prior_model
+    teacher.to(args.device)
+    teacher.eval()
+    return teacher, training_args, model.state_dict()
+
+
+def create_student(args, training_args):
+    student_args = copy.deepcopy(training_args)
+    student_args.prior_model = 'bow'
+    student_args.uniform_prior = False
+    student_args.entropy_regularize_prior_wt = 0.0
+    student_args.use_structured_prior = args.use_structured_prior
+    student_args.use_structured_prior_binarypotential = args.use_structured_prior_binarypotential
+    student_args.effect_emb_dim = args.effect_emb_dim
+    student_args.device = args.device
+    student = PriorBoWModel(student_args)
+    student.to(args.device)
+    return student, student_args
+
+
+def prior_distributions(teacher, student, batch):
+    ''' returns p(z|H) of the teacher (no gradient) and of the student: B x P each '''
+    with torch.no_grad():
+        teacher_prob = teacher.get_prob_z_given_H(
+            batch['persona'], batch['history'], batch['effects'], batch['persona_length'], batch['history_length'])
+    student_prob = student.get_prob_z_given_H(batch['persona'], batch['history'], batch['effects'])
+    return teacher_prob, student_prob
+
+
+def kl_divergence(teacher_prob, student_prob):
+    ''' KL(teacher || student) of every example: B '''
+    return torch.sum(teacher_prob * (torch.log(teacher_prob) - torch.log(student_prob)), dim=-1)
+
+
+def evaluate(teacher, student, loader, args):
+    ''' Mean KL(teacher || student) and how often both priors rank the same persona first '''
+    student.eval()
+    kl_sum, num_agree, num_examples = 0.0, 0, 0
+    with torch.no_grad():
+        for batch in tqdm(loader, desc='evaluate'):
+            batch = {name: input_tensor.to(args.device) for name, input_tensor in batch.items()}
+            teacher_prob, student_prob = prior_distributions(teacher, student, batch)
+            kl_sum += kl_divergence(teacher_prob, student_prob).sum().item()
+            num_agree += (teacher_prob.argmax(-1) == student_prob.argmax(-1)).sum().item()
+            num_examples += teacher_prob.shape[0]
+    return kl_sum / num_examples, num_agree / float(num_examples)
+
+
+def time_prior(prior_fn, batches, args):
+    ''' seconds per batch of prior_fn(batch) without gradients '''
+    with torch.no_grad():
+        prior_fn(batches[0])  # warm up
+        if str(args.device).startswith('cuda'):
+            torch.cuda.synchronize()
+        start = time.time()
+        for batch in batches:
+            prior_fn(batch)
+        if str(args.device).startswith('cuda'):
+            torch.cuda.synchronize()
+    return (time.time() - start) / len(batches)
+
+
+def distill():
+    args = get_args()
+    print("Arguments: {}".format(pformat(args)))
+
+    tokenizer = GPT2Tokenizer.from_pretrained('gpt2')
+    tokenizer.add_special_tokens(ATTR_TO_SPECIAL_TOKEN)
+    teacher, training_args, model_weights = load_teacher(args, len(tokenizer))
+    student, student_args = create_student(args, training_args)
+    optimizer = torch.optim.Adam(student.parameters(), lr=args.lr)
+
+    train_dataset = PersonaChatDataset(args, tokenizer, split='train')
+    train_loader = DataLoader(train_dataset, sampler=RandomSampler(train_dataset), batch_size=args.train_batch_size,
+                              collate_fn=partial(train_dataset.collate_dialog))
+    val_dataset = PersonaChatDataset(args, tokenizer, split='valid')
+    val_loader = DataLoader(val_dataset, sampler=SequentialSampler(val_dataset), batch_size=args.valid_batch_size,
+                            collate_fn=partial(val_dataset.collate_dialog))
+
+    kl, agreement = evaluate(teacher, student, val_loader, args)
+    print('Before distillation: KL(roberta || bow) = {:.4f}, top-1 agreement = {:.1%}'.format(kl, agreement))
+    for epoch in range(args.n_epochs):
+        student.train()
+        pbar = tqdm(train_loader, desc='epoch {}'.format(epoch))
+        for batch in pbar:
+            batch = {name: input_tensor.to(args.device) for name, input_tensor in batch.items()}
+            teacher_prob, student_prob = prior_distributions(teacher, student, batch)
+            loss = kl_divergence(teacher_prob, student_prob).mean()
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            pbar.set_postfix(kl=loss.item())
+        kl, agreement = evaluate(teacher, student, val_loader, args)
+        print('Epoch {}: KL(roberta || bow) = {:.4f}, top-1 agreement = {:.1%}'.format(epoch, kl, agreement))
+
+    student.eval()
+    speed_batches = []
+    for batch in val_loader:
+        speed_batches.append({name: input_tensor.to(args.device) for name, input_tensor in batch.items()})
+        if len(speed_batches) == args.num_speed_batches:
+            break
+    teacher_seconds = time_prior(lambda b: teacher.get_prob_z_given_H(
+        b['persona'], b['history'], b['effects'], b['persona_length'], b['history_length']), speed_batches, args)
+    student_seconds = time_prior(lambda b: student.get_prob_z_given_H(b['persona'], b['history'], b['effects']), speed_batches, args)
+    print('Prior sec/batch: roberta {:.4f}, bow {:.4f} ({:.1f}x faster)'.format(
+        teacher_seconds, student_seconds, teacher_seconds / student_seconds))
+
+    # a run directory that generate.py / interact.py load as a model with the BoW prior
+    log_dir = os.path.join(args.log_dir, make_logdir('bow', args.exp_name))
+    os.makedirs(log_dir, exist_ok=True)
+    model_weights = {name: weight for name, weight in model_weights.items() if not name.startswith('prior_model.')}
+    model_weights.update({'prior_model.' + name: weight.cpu() for name, weight in student.state_dict().items()})
+    torch.save(model_weights, os.path.join(log_dir, 'checkpoint_mymodel_distilled.pth'))
+    torch.save(student_args, os.path.join(log_dir, 'model_training_args.bin'))
+    tokenizer.save_pretrained(log_dir)
+    print('Saved the model with the distilled prior at {}'.format(log_dir))
+
+
+if __name__ == "__main__":
+    distill()
+
+'''
+Distill the prior of a RoBERTa-prior run into a BoW prior with structured features:
+
+python3 -m models.reinforce_model.distill_prior --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --model_checkpoint_dir=models/reinforce_model/runs/RUN_DIR --load_checkpoint_from=checkpoint_mymodel_130408.pth --max_history=2 --num_candidates=1 --train_batch_size=2 --valid_batch_size=2 --use_structured_prior --use_structured_prior_binarypotential --log_dir models/reinforce_model/ --exp_name distilled_prior
+'''
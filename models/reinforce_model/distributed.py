@@ -0,0 +1,33 @@
+import os
+
+import torch
+
+
+def init_distributed(args):
+    '''
+    NCCL with one GPU per process, or gloo on CPU with every process pinned to its own share of the cores.
+    Launched with torch.distributed.launch (--local_rank) or torchrun (LOCAL_RANK).
+    '''
+    if torch.device(args.device).type == 'cuda':
+        torch.cuda.set_device(args.local_rank)
+        args.device = torch.device("cuda", args.local_rank)
+        torch.distributed.init_process_group(backend='nccl', init_method='env://')
+    else:
+        args.device = torch.device("cpu")
+        pin_cpu_threads(args.local_rank, args.num_threads_per_rank)
+        torch.distributed.init_process_group(backend='gloo', init_method='env://')
+
+
+def pin_cpu_threads(local_rank, num_threads=0):
+    '''
+    Pins this process to its own block of the available cores and uses as many intra-op threads, so that the
+    processes of a host do not oversubscribe the cores. num_threads <= 0: the cores split evenly between them.
+    '''
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', os.environ.get('WORLD_SIZE', 1)))
+    if num_threads <= 0:
+        num_threads = max(1, len(cores) // local_world_size)
+    own_cores = cores[local_rank * num_threads:(local_rank + 1) * num_threads]
+    if own_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, own_cores)
+    torch.set_num_threads(len(own_cores) or num_threads)
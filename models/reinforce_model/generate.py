@@ -9,8 +9,9 @@ from models.reinforce_model.utils import get_dataset, make_logdir
 from models.reinforce_model.data import PADDED_INPUTS, ATTR_TO_SPECIAL_TOKEN
 from models.reinforce_model.dataset import PersonaChatDataset, collate_dialog
 from models.reinforce_model.train import add_special_tokens_
-from models.reinforce_model.model_with_inferencenw import LatentMarginalizedModel, LatentVariableInferenceModel
+from models.reinforce_model.model_with_inferencenw import LatentVariableInferenceModel, load_latent_variable_model
 from models.reinforce_model.interact import sample_sequence
+from models.reinforce_model.prior_posterior_models import BoWPriorState, PriorBoWModel
 
 import torch
 import math
@@ -81,18 +82,12 @@ num_added_tokens = tokenizer.add_special_tokens(ATTR_TO_SPECIAL_TOKEN)
 print('Tokenizer new length: {}'.format(len(tokenizer.encoder)))
 
 model_class = GPT2LMHeadModel
-model = LatentVariableInferenceModel(training_args, generator_class=model_class)
-model.gpt2_model.resize_token_embeddings(new_num_tokens=orig_num_tokens + num_added_tokens)
-
 model_checkpoint_path = os.path.join(args.model_checkpoint_dir, args.load_checkpoint_from)
-model_weights = torch.load(
-        model_checkpoint_path, map_location=lambda storage, loc: storage
-    )
-model.load_state_dict(model_weights, strict=False)
+model = load_latent_variable_model(
+    training_args, model_class, model_checkpoint_path, num_tokens=orig_num_tokens + num_added_tokens,
+    device=args.device)
 print('Loaded model weights from {}'.format(model_checkpoint_path))
 
-model.to(args.device)
-
 # Add special tokens if they are not already added
 # add_special_tokens_(model, tokenizer)
 
@@ -109,6 +104,8 @@ ppls = []
 losses = []
 
 all_generations = []
+# consecutive validation turns of a dialog share their personas and extend their history
+prior_state = BoWPriorState() if isinstance(model.prior_model, PriorBoWModel) else None
 
 for i, item in tqdm(enumerate(val_dataset), total=len(val_dataset)):
     model.eval()
@@ -131,7 +128,7 @@ for i, item in tqdm(enumerate(val_dataset), total=len(val_dataset)):
         ground_truth = [t for t in lm_labels[0][0] if t!= -100]
         ground_truth_text = tokenizer.decode(ground_truth, skip_special_tokens=True)
 
-        out_ids, z = sample_sequence(persona, history_folded, effects, tokenizer, model, args, current_output=None, persona_choice=None)
+        out_ids, z = sample_sequence(persona, history_folded, effects, tokenizer, model, args, current_output=None, persona_choice=None, prior_state=prior_state)
         out_text = tokenizer.decode(out_ids, skip_special_tokens=True)
 
         retrieved_persona = tokenizer.decode(persona[z][1:], skip_special_tokens=True)
@@ -11,9 +11,10 @@ import torch.nn.functional as F
 
 from transformers import OpenAIGPTLMHeadModel, OpenAIGPTTokenizer, GPT2LMHeadModel, GPT2Tokenizer
 from models.reinforce_model.train import add_special_tokens_
-from models.reinforce_model.dataset import SPECIAL_TOKENS, build_input_from_segments, ATTR_TO_SPECIAL_TOKEN, ROBERTA_START
+from models.reinforce_model.dataset import SPECIAL_TOKENS, build_input_from_segments, ATTR_TO_SPECIAL_TOKEN, ROBERTA_START, EFFECTS
 from models.reinforce_model.utils import get_dataset, download_pretrained_model
-from models.reinforce_model.model import LatentMarginalizedModel
+from models.reinforce_model.model_with_inferencenw import load_latent_variable_model
+from models.reinforce_model.prior_posterior_models import BoWPriorState, PriorBoWModel
 
 def top_filtering(logits, top_k=0., top_p=0.9, threshold=-float('Inf'), filter_value=-float('Inf')):
     """ Filter a distribution of logits using top-k, top-p (nucleus) and/or threshold filtering
@@ -54,7 +55,7 @@ def top_filtering(logits, top_k=0., top_p=0.9, threshold=-float('Inf'), filter_v
     return logits
 
 
-def sample_sequence(personality, history, effects, tokenizer, model, args, current_output=None, persona_choice=None, add_roberta_start=False):
+def sample_sequence(personality, history, effects, tokenizer, model, args, current_output=None, persona_choice=None, add_roberta_start=False, prior_state=None):
     special_tokens_ids = tokenizer.convert_tokens_to_ids(SPECIAL_TOKENS)
     if current_output is None:
         current_output = []
@@ -67,6 +68,7 @@ def sample_sequence(personality, history, effects, tokenizer, model, args, curre
         max_persona_len = max(max_persona_len, len(p))
 
     padded_persona_tensor = torch.LongTensor([p + [0]*(max_persona_len - len(p)) for p in preprocess_persona]).unsqueeze(0).to(args.device) 
+    persona_length = torch.LongTensor([len(p) for p in preprocess_persona]).unsqueeze(0).to(args.device)
     # 1 x T
     history_flat_tensor = torch.LongTensor([ROBERTA_START] + list(chain(*history))).unsqueeze(0).to(args.device)
     padded_effects = torch.LongTensor(effects).unsqueeze(0).to(args.device)
@@ -74,7 +76,13 @@ def sample_sequence(personality, history, effects, tokenizer, model, args, curre
     if persona_choice:
         z = int(persona_choice)
     else:
-        prior_z = model.prior_model.get_prob_z_given_H(padded_persona_tensor, history_flat_tensor, padded_effects) # B x P
+        if prior_state is not None:
+            # BoW prior: only the new history tokens are embedded, the personas are cached for the dialog
+            prior_z = model.prior_model.get_prob_z_given_H_incremental(
+                padded_persona_tensor, history_flat_tensor, padded_effects, prior_state) # B x P
+        else:
+            prior_z = model.prior_model.get_prob_z_given_H(
+                padded_persona_tensor, history_flat_tensor, padded_effects, persona_length=persona_length) # B x P
         # z = torch.argmax(prior_z, dim=1).item()
         z, _ = model.prior_model.sample(prior_z)
         z = z.item()
@@ -154,25 +162,15 @@ def run():
     print('Tokenizer length: {}'.format(orig_num_tokens))
     num_added_tokens = tokenizer.add_special_tokens(ATTR_TO_SPECIAL_TOKEN)
     print('Tokenizer new length: {}'.format(len(tokenizer.encoder)))
-    model = LatentMarginalizedModel(training_args, generator_class=model_class)
-    model.gpt2_model.resize_token_embeddings(new_num_tokens=orig_num_tokens + num_added_tokens)
     # add_special_tokens_(model, tokenizer)
 
     # Load model weights
     model_checkpoint_path = os.path.join(args.model_checkpoint_dir, args.load_checkpoint_from)
-    model_weights = torch.load(
-        model_checkpoint_path, map_location=lambda storage, loc: storage
-    )
-    # corrected_model_weights = {}
-    # for k, v in model_weights.items():
-    #     new_k = k.replace('gpt2_model.', '').replace('', '')
-    #     corrected_model_weights[k.replace('gpt2_model.', '')] = v
-
-    model.load_state_dict(model_weights, strict=False)
+    model = load_latent_variable_model(
+        training_args, model_class, model_checkpoint_path, num_tokens=orig_num_tokens + num_added_tokens,
+        device=args.device)
     print('Loaded model weights from {}'.format(model_checkpoint_path))
 
-    model.to(args.device)
-
     logger.info("Sample a personality")
     dataset = get_dataset(tokenizer, args.dataset_path, args.dataset_cache)
     # select train or validation split
@@ -199,8 +197,10 @@ def run():
     # personality += sent_beams
     print(personality)
     logger.info("Selected personality: %s", tokenizer.decode(chain(*personality)))
+    effects = [EFFECTS['Persona']] * len(personality)  # the original persona sentences, no COMET expansions
 
     history = []
+    prior_state = BoWPriorState() if isinstance(model.prior_model, PriorBoWModel) else None
     while True:
         raw_text = input(">>> ")
         while not raw_text:
@@ -209,7 +209,8 @@ def run():
         history.append(tokenizer.encode(raw_text))
         raw_choice = input("Give persona choice >>> ")
         with torch.no_grad():
-            out_ids = sample_sequence(personality, history, tokenizer, model, args, persona_choice=raw_choice)
+            out_ids, z = sample_sequence(personality, history, effects, tokenizer, model, args, persona_choice=raw_choice, prior_state=prior_state)
+        print('Persona {}: {}'.format(z, tokenizer.decode(personality[z])))
         history.append(out_ids)
         history = history[-(2*args.max_history+1):]
         out_text = tokenizer.decode(out_ids, skip_special_tokens=True)
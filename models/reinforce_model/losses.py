@@ -0,0 +1,92 @@
+import torch
+
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    '''
+    Cross-entropy of a linear LM head, computed over blocks of the vocabulary so that the M x V logits are never
+    materialized: at most M x chunk_size logits are alive, in the forward as well as in the backward pass.
+    '''
+
+    @staticmethod
+    def forward(ctx, hidden_states, weight, labels, chunk_size):
+        '''
+        hidden_states: M x H
+        weight: V x H (the LM head, e.g. tied to the input embeddings)
+        labels: M, without ignored positions
+        returns the per-token loss: M
+        '''
+        num_tokens, vocab_size = hidden_states.shape[0], weight.shape[0]
+        log_normalizer = torch.full((num_tokens,), -float('inf'), dtype=torch.float, device=hidden_states.device)
+        target_logits = torch.zeros(num_tokens, dtype=torch.float, device=hidden_states.device)
+        for start in range(0, vocab_size, chunk_size):
+            logits = (hidden_states @ weight[start:start + chunk_size].T).float()  # M x chunk
+            log_normalizer = torch.logaddexp(log_normalizer, torch.logsumexp(logits, dim=1))
+            in_chunk = (labels >= start) & (labels < start + logits.shape[1])
+            target_logits[in_chunk] = logits[in_chunk, labels[in_chunk] - start]
+        ctx.chunk_size = chunk_size
+        ctx.save_for_backward(hidden_states, weight, labels, log_normalizer)
+        return log_normalizer - target_logits
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        hidden_states, weight, labels, log_normalizer = ctx.saved_tensors
+        chunk_size = ctx.chunk_size
+        grad_hidden_states = torch.zeros_like(hidden_states, dtype=torch.float) if ctx.needs_input_grad[0] else None
+        grad_weight = torch.zeros_like(weight, dtype=torch.float) if ctx.needs_input_grad[1] else None
+        rows = torch.arange(hidden_states.shape[0], device=hidden_states.device)
+        for start in range(0, weight.shape[0], chunk_size):
+            weight_chunk = weight[start:start + chunk_size]
+            # d loss / d logits = softmax - one_hot(label)
+            grad_logits = torch.exp((hidden_states @ weight_chunk.T).float() - log_normalizer.unsqueeze(1))  # M x chunk
+            in_chunk = (labels >= start) & (labels < start + weight_chunk.shape[0])
+            grad_logits[rows[in_chunk], labels[in_chunk] - start] -= 1.0
+            grad_logits *= grad_loss.unsqueeze(1)
+            if grad_hidden_states is not None:
+                grad_hidden_states += grad_logits @ weight_chunk.float()
+            if grad_weight is not None:
+                grad_weight[start:start + chunk_size] = grad_logits.T @ hidden_states.float()
+        if grad_hidden_states is not None:
+            grad_hidden_states = grad_hidden_states.to(hidden_states.dtype)
+        if grad_weight is not None:
+            grad_weight = grad_weight.to(weight.dtype)
+        return grad_hidden_states, grad_weight, None, None
+
+
+def chunked_cross_entropy(hidden_states, weight, labels, chunk_size):
+    '''
+    hidden_states: M x H, weight: V x H, labels: M
+    returns -log softmax(hidden_states @ weight.T)[labels]: M, with the vocabulary processed chunk_size entries at a time
+    '''
+    return ChunkedCrossEntropy.apply(hidden_states, weight, labels, chunk_size)
+
+
+def chunked_entropy(hidden_states, weight, chunk_size):
+    '''
+    hidden_states: M x H, weight: V x H
+    returns the entropy of every predicted distribution over the vocabulary: M (no gradient)
+    '''
+    with torch.no_grad():
+        log_normalizer = torch.full((hidden_states.shape[0],), -float('inf'), dtype=torch.float, device=hidden_states.device)
+        for start in range(0, weight.shape[0], chunk_size):
+            logits = (hidden_states @ weight[start:start + chunk_size].T).float()
+            log_normalizer = torch.logaddexp(log_normalizer, torch.logsumexp(logits, dim=1))
+        expected_logit = torch.zeros_like(log_normalizer)
+        for start in range(0, weight.shape[0], chunk_size):
+            logits = (hidden_states @ weight[start:start + chunk_size].T).float()
+            expected_logit += (torch.exp(logits - log_normalizer.unsqueeze(1)) * logits).sum(1)
+        return log_normalizer - expected_logit
+
+
+def double_heads_chunked(model, input_ids, token_type_ids, mc_token_ids, lm_labels, chunk_size):
+    '''
+    The baselines' double-heads forward with the chunked cross-entropy in place of the full LM logits.
+    input_ids, token_type_ids, lm_labels: B x C x T (-1 marks unlabelled tokens)
+    mc_token_ids: B x C
+    returns the nll of every labelled token: M, and the mc logits: B x C
+    '''
+    hidden_states = model.transformer(input_ids, token_type_ids=token_type_ids)[0]
+    mc_logits = model.multiple_choice_head(hidden_states, mc_token_ids).squeeze(-1)
+    lm_labels_shifted = lm_labels[..., 1:]
+    labelled = lm_labels_shifted != -1
+    token_nll = chunked_cross_entropy(hidden_states[..., :-1, :][labelled], model.lm_head.weight, lm_labels_shifted[labelled], chunk_size)
+    return token_nll, mc_logits
@@ -1,44 +1,122 @@
+import copy
+
 from transformers import RobertaForSequenceClassification
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from models.reinforce_model.prior_posterior_models import PriorRobertaModel, InferenceRobertaModel
+from torch.utils.checkpoint import checkpoint
+from models.reinforce_model.prior_posterior_models import PriorBoWModel, PriorRobertaModel, InferenceRobertaModel, skip_init_weights
 from models.reinforce_model.dataset import EFFECTS
+from models.reinforce_model.losses import chunked_cross_entropy, chunked_entropy
+from models.reinforce_model.packing import PackedBatch, packed_gpt2_hidden_states
+from models.reinforce_model.checkpointing import exported_base, is_exported, load_model_weights, read_checkpoint
+from models.reinforce_model.activation_checkpointing import checkpoint_blocks, parse_submodules
+from models.reinforce_model.profiling import StageTimer
 
 TRAINING_TYPE_MARGINALIZE = 'marginalize'
 TRAINING_TYPE_REINFORCE = 'reinforce'
+TRAINING_TYPE_TOPK = 'topk'
+
+
+def select_personas(tensor, index):
+    '''
+    tensor: B x P x ...
+    index: B x K
+    returns: B x K x ..., the chosen personas of every example
+    '''
+    batch_index = torch.arange(tensor.shape[0], device=tensor.device).unsqueeze(1)
+    return tensor[batch_index, index]
+
+
+def per_sample_reward_stats(rewards):
+    '''
+    rewards: B x K, of the K samples (personas) of every example
+    returns [mean over the examples of the std of their K rewards (0 for K=1), min, max]: 3
+    '''
+    return torch.stack([rewards.std(1, unbiased=False).mean(), rewards.min(), rewards.max()])
+
+
+def load_latent_variable_model(training_args, generator_class, checkpoint_path, num_tokens, device='cpu'):
+    '''
+    LatentVariableInferenceModel on device with the weights of a checkpoint (a pickled .pth or a directory exported
+    by models.reinforce_model.checkpointing). The architecture is built from the configs only, so no pretrained
+    weights are downloaded, loaded or initialized just to be overwritten. A trainable / delta checkpoint only has
+    the trained parameters: the model is built from the base weights it references, which it then overwrites.
+    num_tokens: vocabulary size of the checkpoint's GPT2 (with the special tokens)
+    '''
+    if is_exported(checkpoint_path):
+        model_weights, base = None, exported_base(checkpoint_path)
+    else:
+        model_weights, base = read_checkpoint(checkpoint_path)
+    if base is None:
+        model = LatentVariableInferenceModel(training_args, generator_class=generator_class, pretrained=False)
+    else:
+        base_args = copy.copy(training_args)
+        vars(base_args).update(base)
+        model = LatentVariableInferenceModel(base_args, generator_class=generator_class)
+        if base['model_checkpoint'] is not None:
+            model.load_state_dict(torch.load(base['model_checkpoint'], map_location=lambda storage, loc: storage), strict=False)
+    model.gpt2_model.resize_token_embeddings(new_num_tokens=num_tokens)
+    model.to(device)
+    missing_keys = load_model_weights(model, checkpoint_path, device, model_weights)
+    if missing_keys and base is None:
+        print('Weights not in the checkpoint, left uninitialized: {}'.format(missing_keys))
+    elif missing_keys:
+        print('{} weights not in the checkpoint, kept from {}'.format(len(missing_keys), base))
+    return model
 
 
 class LatentVariableInferenceModel(nn.Module):
     def __init__(self,
                  args,
-                 generator_class):
+                 generator_class,
+                 pretrained=True):
+        '''
+        pretrained=False builds every submodule from its config without loading pretrained weights,
+        for a model whose checkpoint is loaded next (see load_latent_variable_model)
+        '''
         super().__init__()
 
         self.args = args
+        encoder_cache = {}  # the prior and the inference network load a shared backbone only once
         if args.prior_model == 'bow':
-            raise NotImplementedError
+            self.prior_model = PriorBoWModel(args, pretrained, encoder_cache)
+            self.inference_model = InferenceRobertaModel(args, pretrained, encoder_cache)
         elif args.prior_model == 'roberta':
-            self.prior_model = PriorRobertaModel(args)
-            self.inference_model = InferenceRobertaModel(args)
+            self.prior_model = PriorRobertaModel(args, pretrained, encoder_cache)
+            self.inference_model = InferenceRobertaModel(args, pretrained, encoder_cache)
         else:
             raise Exception('Invalid prior model')
 
-        self.gpt2_model = generator_class.from_pretrained(args.generation_model)
+        if pretrained:
+            self.gpt2_model = generator_class.from_pretrained(args.generation_model)
+        else:
+            with skip_init_weights():
+                self.gpt2_model = generator_class(generator_class.config_class.from_pretrained(args.generation_model))
         self.criterion_lm = torch.nn.CrossEntropyLoss(ignore_index=-100, reduction='none')
         self.criterion_mc = torch.nn.CrossEntropyLoss(reduction='none')
 
         if args.training_type == 'reinforce':
             self.training_type = TRAINING_TYPE_REINFORCE
+        elif args.training_type == 'topk':
+            self.training_type = TRAINING_TYPE_TOPK
+        elif args.training_type == 'marginalize':
+            self.training_type = TRAINING_TYPE_MARGINALIZE
         else:
-            self.training_type = TRAINING_TYPE_MARGINALIZE  # default
-            raise NotImplementedError
+            raise ValueError("Invalid training type {!r}, expected 'marginalize', 'reinforce' or 'topk'".format(args.training_type))
+        self.marginalize_chunk_size = getattr(args, 'marginalize_chunk_size', 0)
+        self.topk_personas = getattr(args, 'topk_personas', 1)
+        self.num_reinforce_samples = getattr(args, 'num_reinforce_samples', 1)
+        self.chunked_ce_size = getattr(args, 'chunked_ce_size', 0)
+        self.pack_length = getattr(args, 'pack_length', 0)
+        self.enable_gradient_checkpointing(parse_submodules(getattr(args, 'gradient_checkpointing', '')))
 
         print('Model loaded with training type {}'.format(self.training_type))
 
-        assert self.training_type in [TRAINING_TYPE_REINFORCE, TRAINING_TYPE_MARGINALIZE]
         self.running_mean = None  # -- todo: maybe init as 0?
+        self.selected_personas = None  # B x K, the personas of the last log_likelihood_selected call
+        self.stage_timer = StageTimer()  # disabled; train.py replaces it to time the stages of training steps
         self.use_baseline = args.use_baseline
         self.moving_avg_ratio = args.moving_avg_ratio
         self.reinforce_loss_coef = args.reinforce_loss_coef
@@ -59,123 +137,153 @@ class LatentVariableInferenceModel(nn.Module):
             **kwargs):
         '''
         persona: B x P x T
+        persona_length: B x P, history_length: B (in kwargs, optional)
         input_ids: B x P x C x T
         mc_token_ids:
         lm_labels: B x P x C x T
         mc_labels: B
         token_type_ids: B x P x C x T
+
+        reward_var, the next to last output, is the variance of the baseline-subtracted REINFORCE rewards (the
+        advantages that scale the score-function gradient of every sample), not of the gradient itself.
+        reward_stats, the last output, describes the rewards (log-likelihood per label) of the individual samples:
+        [mean over the examples of the std over their samples, min, max] (see per_sample_reward_stats)
         '''
         effects = kwargs.get('effects', None)
+        persona_length = kwargs.get('persona_length', None)
+        history_length = kwargs.get('history_length', None)
 
         sampler_model = self.inference_model
 
         if not generate:
 
-            z_given_h_and_x = sampler_model.get_prob_z_given_H_and_x(mc_token_ids, persona, history, effects)  # B x P
-            z_given_h = self.prior_model.get_prob_z_given_H(persona, history, effects)  # B x P
-
-            log_probs_lm = []
-            log_probs_mc = []
+            with self.stage_timer.stage('prior', self.training):
+                z_given_h = self.prior_model.get_prob_z_given_H(
+                    persona, history, effects, persona_length, history_length)  # B x P
+            num_labels = (lm_labels[:, 0] != -100).sum([-2, -1])  # B, the reply is the same for every persona
 
-            # z_iterator = range(input_ids.shape[1])
             if self.training_type == TRAINING_TYPE_MARGINALIZE:
-                z_iterator = range(input_ids.shape[1])
-                raise NotImplementedError
-            elif self.training_type == TRAINING_TYPE_REINFORCE:
-                action, logprob_action = sampler_model.sample(z_given_h_and_x)
+                # exact marginalization over all personas: log p(x|H) = logsumexp_z log p(x|z,H) + log p(z|H)
+                # no posterior is needed, so the inference network is not run
+                with self.stage_timer.stage('gpt2', self.training):
+                    log_prob_x_given_z = self.log_likelihood_all_personas(
+                        input_ids, token_type_ids, mc_token_ids, lm_labels)  # B x P
+                log_prob_x_z_given_h = log_prob_x_given_z + torch.log(z_given_h)  # B x P
+                if interpret:
+                    return log_prob_x_z_given_h / num_labels.unsqueeze(1)
+                log_sum_exp_lm = torch.logsumexp(log_prob_x_z_given_h, dim=1)  # B
+                loss_lm = -1.0 * (log_sum_exp_lm / num_labels).mean()
+                total_loss_lm = loss_lm
+                elbo_loss_tracking = loss_lm
+                zero = torch.zeros(1, device=self.args.device)
+                loss_prior, track_rewards, kl_loss, reward_var = zero, zero, zero, zero
+                reward_stats = torch.zeros(3, device=self.args.device)
+
+                if self.training:
+                    lm_logits, mc_logits = None, None
+                else:
+                    # logits of the most likely persona a posteriori, for the evaluation metrics
+                    best = torch.argmax(log_prob_x_z_given_h, dim=1).unsqueeze(1)  # B x 1
+                    _, lm_logits, mc_logits = self.log_likelihood_selected(
+                        best, input_ids, token_type_ids, mc_token_ids, lm_labels)
+                loss_mc = torch.Tensor([0.0]).to(self.args.device)
+                return lm_logits, mc_logits, total_loss_lm, loss_mc, loss_prior, loss_lm, num_labels, track_rewards, kl_loss, elbo_loss_tracking, reward_var, reward_stats
+
+            with self.stage_timer.stage('posterior', self.training):
+                z_given_h_and_x = sampler_model.get_prob_z_given_H_and_x(
+                    mc_token_ids, persona, history, effects, persona_length, history_length)  # B x P
+
+            if self.training_type == TRAINING_TYPE_REINFORCE and self.num_reinforce_samples > 1:
+                # K actions per example, all K x B sequences in one GPT2 pass, and a leave-one-out baseline:
+                # every sample is compared against the mean reward of the other K-1 samples of its example
+                num_samples = self.num_reinforce_samples
+                with self.stage_timer.stage('sample', self.training):
+                    action, logprob_action = sampler_model.sample(z_given_h_and_x, num_samples)  # B x K
+                ll_lm, lm_logits, mc_logits = self.log_likelihood_selected(
+                    action, input_ids, token_type_ids, mc_token_ids, lm_labels)  # B x K
+                lm_logits, mc_logits = self.first_selected(lm_logits), mc_logits[:, :1]
+                log_probs_lm = ll_lm / num_labels.unsqueeze(1)  # B x K
+
+                loss_lm = -1.0 * log_probs_lm.mean()
+                rewards = log_probs_lm.detach()  # B x K
+                track_rewards = rewards.mean()
+                reward_stats = per_sample_reward_stats(rewards)
+                baseline = (rewards.sum(1, keepdim=True) - rewards) / (num_samples - 1)  # B x K
+                rewards = rewards - baseline
+                reward_var = rewards.var(unbiased=False)
+                loss_prior = - logprob_action * rewards  # B x K
+                loss_prior = loss_prior.mean()
 
-                z_iterator = [action]  # in case of reinforce, do fwd for only one value of z
+            elif self.training_type == TRAINING_TYPE_REINFORCE:
+                # in case of reinforce, do fwd for only one value of z
+                with self.stage_timer.stage('sample', self.training):
+                    action, logprob_action = sampler_model.sample(z_given_h_and_x)
                 # z_given_h = z_given_h.detach()  # do not update prior through log likelihood since we are not marginalizing. we will instead update it through reinforce
-
-            for i in z_iterator:
-
-                if self.training_type == TRAINING_TYPE_MARGINALIZE:
-                    lm_logits, mc_logits, *_ = self.gpt2_model(
-                        input_ids[:, i, ...].contiguous(),
-                        token_type_ids=token_type_ids[:, i, ...].contiguous(),
-                        mc_token_ids=mc_token_ids[:, i, ...].contiguous(),
-                    )
-                    lm_labels_persona = lm_labels[:, i, ...]
-                    mc_labels_persona = mc_labels[:, i, ...]
-
-                elif self.training_type == TRAINING_TYPE_REINFORCE:
-                    input_ids = torch.cat(
-                        [torch.index_select(ip, 0, ind).unsqueeze(0) for ip, ind in zip(input_ids, i)])
-                    token_type_ids = torch.cat(
-                        [torch.index_select(ip, 0, ind).unsqueeze(0) for ip, ind in zip(token_type_ids, i)])
-                    mc_token_ids = torch.cat(
-                        [torch.index_select(ip, 0, ind).unsqueeze(0) for ip, ind in zip(mc_token_ids, i)])
-                    lm_labels_persona = torch.cat(
-                        [torch.index_select(ip, 0, ind).unsqueeze(0) for ip, ind in zip(lm_labels, i)])
-                    mc_labels_persona = torch.cat(
-                        [torch.index_select(ip, 0, ind).unsqueeze(0) for ip, ind in zip(mc_labels, i)])
-                    lm_logits, mc_logits, *_ = self.gpt2_model(
-                        input_ids,
-                        token_type_ids=token_type_ids,
-                        mc_token_ids=mc_token_ids,
-                    )
-
-                # LM
-                lm_logits_flat_shifted = lm_logits[..., :-1, :].contiguous().view(-1, lm_logits.size(-1))
-                lm_labels_flat_shifted = lm_labels_persona[..., 1:].contiguous().view(-1)
-                num_labels = (lm_labels_persona != -100).sum([-3, -2, -1])  # B
-                ll_lm = -1 * self.criterion_lm(lm_logits_flat_shifted, lm_labels_flat_shifted)  # B x C x T
-                ll_lm = ll_lm.view(lm_labels.size(0), -1).sum(1)  # B
-
-                log_prob_x_z_given_h = ll_lm
-                if self.training_type == TRAINING_TYPE_MARGINALIZE:
-                    log_prob_x_z_given_h += torch.log(z_given_h[:, i])  # B
-                log_probs_lm.append(log_prob_x_z_given_h / num_labels)  # This line is trhowing error
+                ll_lm, lm_logits, mc_logits = self.log_likelihood_selected(
+                    action.unsqueeze(1), input_ids, token_type_ids, mc_token_ids, lm_labels)
+                log_probs_lm = ll_lm.squeeze(1) / num_labels  # B
 
                 # # MC
                 # ll_mc = -1.0 * self.criterion_mc(mc_logits.view(-1, mc_logits.size(-1)), mc_labels_persona.view(-1))
                 # ll_mc = ll_mc.view(mc_labels.size(0), -1).sum(-1)
 
-                # log_prob_x_given_z_h_mc = ll_mc + torch.log(z_given_h[:, i])  # B
-                # log_probs_mc.append(log_prob_x_given_z_h_mc)
-
-            if self.training_type == TRAINING_TYPE_MARGINALIZE:
-                # LM
-                log_probs_lm = torch.stack(log_probs_lm).T  # B x P
-                if interpret:
-                    return log_probs_lm
-                log_sum_exp_lm = torch.logsumexp(log_probs_lm, dim=1)  # logsumexp,  B
-                total_loss_lm = -1.0 * log_sum_exp_lm.mean()
-                loss_prior, reinforce_loss_lm = torch.Tensor([0.0]).to(self.args.device), torch.Tensor([0.0]).to(
-                    self.args.device)
-
-            elif self.training_type == TRAINING_TYPE_REINFORCE:
                 # not when using reinforce, loss_lm is not log p(x) but log p(x|z=action) -- so be careful when compuing the perplexity
                 # LM
-                # log_probs_lm: P=1 values for B=batch_size. pick the first and only value
-                log_probs_lm = log_probs_lm[0]  # log_probs_lm:B
                 log_sum_exp_lm = log_probs_lm  # B
                 loss_lm = -1.0 * log_sum_exp_lm.mean()
                 # reward: we want to reward those actions which lead to higher
                 rewards = log_sum_exp_lm.detach()  # important to detach -> to not update the conditional model
                 track_rewards = rewards.mean()
+                reward_stats = per_sample_reward_stats(rewards.unsqueeze(1))
                 if self.use_baseline:
-                    if not self.running_mean:
+                    if self.running_mean is None:
                         self.running_mean = rewards.mean().detach()  # 1
                     else:
                         ratio = 0.99
                         self.running_mean = ratio * self.running_mean + (1.0 - ratio) * rewards.mean()
                     rewards = rewards - self.running_mean.detach()  # B
+                reward_var = rewards.var(unbiased=False)
 
                 # todo - should do some sort of baseline computation for stable reinforce training
                 loss_prior = - logprob_action * rewards  # B
                 loss_prior = loss_prior.mean()  # B
-                # sum the two losses. todo - use a weight on reinforce
-                total_loss_lm = loss_lm + self.reinforce_loss_coef * loss_prior
-                elbo_loss_tracking = loss_lm
 
-                if self.entropy_regularize_prior_wt > 0.0:
-                    if self.training:  # add entropy term only in train mode
-                        # TODO: try with the inference network
-                        # entropy = self.prior_model.entropy(z_given_h)
-                        entropy = self.inference_model.entropy(z_given_h_and_x)
-                        # print("***** entropy = ", entropy)
-                        loss_prior += (-self.entropy_regularize_prior_wt * entropy)  # low entropy is bad
+            elif self.training_type == TRAINING_TYPE_TOPK:
+                # marginalize over the k personas the posterior ranks highest, with the prior renormalized over them
+                k = min(self.topk_personas, z_given_h_and_x.shape[1])
+                with self.stage_timer.stage('sample', self.training):
+                    top_personas = torch.topk(z_given_h_and_x, k, dim=1)[1]  # B x k
+                ll_lm, lm_logits, mc_logits = self.log_likelihood_selected(
+                    top_personas, input_ids, token_type_ids, mc_token_ids, lm_labels)  # B x k
+                # logits of the posterior's best persona, for the evaluation metrics
+                lm_logits, mc_logits = self.first_selected(lm_logits), mc_logits[:, :1]
+
+                log_prior_topk = torch.log(torch.gather(z_given_h, 1, top_personas))  # B x k
+                log_prior_topk = log_prior_topk - torch.logsumexp(log_prior_topk, dim=1, keepdim=True)
+                log_prob_x_z_given_h = ll_lm + log_prior_topk  # B x k
+                log_sum_exp_lm = torch.logsumexp(log_prob_x_z_given_h, dim=1)  # B
+                loss_lm = -1.0 * (log_sum_exp_lm / num_labels).mean()
+                track_rewards = (ll_lm.detach() / num_labels.unsqueeze(1)).mean()
+                reward_stats = per_sample_reward_stats(ll_lm.detach() / num_labels.unsqueeze(1))
+
+                # the posterior is trained towards the exact posterior over the k personas
+                log_posterior_topk = torch.log(torch.gather(z_given_h_and_x, 1, top_personas))  # B x k
+                log_posterior_topk = log_posterior_topk - torch.logsumexp(log_posterior_topk, dim=1, keepdim=True)
+                true_posterior_topk = F.softmax(log_prob_x_z_given_h.detach(), dim=1)  # B x k
+                loss_prior = -1.0 * (true_posterior_topk * log_posterior_topk).sum(1).mean()
+                reward_var = torch.zeros(1, device=self.args.device)
+
+            # sum the two losses. todo - use a weight on reinforce
+            total_loss_lm = loss_lm + self.reinforce_loss_coef * loss_prior
+            elbo_loss_tracking = loss_lm
+
+            if self.entropy_regularize_prior_wt > 0.0:
+                if self.training:  # add entropy term only in train mode
+                    # TODO: try with the inference network
+                    # entropy = self.prior_model.entropy(z_given_h)
+                    entropy = self.inference_model.entropy(z_given_h_and_x)
+                    # print("***** entropy = ", entropy)
+                    loss_prior += (-self.entropy_regularize_prior_wt * entropy)  # low entropy is bad
 
 
             # compute KL term
@@ -188,8 +296,7 @@ class LatentVariableInferenceModel(nn.Module):
             # log_sum_exp_mc = torch.logsumexp(log_probs_mc, dim=1)  # logsumexp
             # loss_mc = -1.0 * log_sum_exp_mc.mean()
             loss_mc = torch.Tensor([0.0]).to(self.args.device)
-            total_loss_lm += 0 * lm_logits.sum() + 0 * mc_logits.sum()  # Fix unsused parameter failure when DDP is used
-            return lm_logits, mc_logits, total_loss_lm, loss_mc, loss_prior, loss_lm, num_labels, track_rewards, kl_loss, elbo_loss_tracking
+            return lm_logits, mc_logits, total_loss_lm, loss_mc, loss_prior, loss_lm, num_labels, track_rewards, kl_loss, elbo_loss_tracking, reward_var, reward_stats
 
         if generate:
             lm_logits = self.gpt2_model(
@@ -199,6 +306,165 @@ class LatentVariableInferenceModel(nn.Module):
 
             return lm_logits
 
+    def enable_gradient_checkpointing(self, submodules):
+        '''
+        submodules: any of 'gpt2', 'prior', 'posterior'; their transformer blocks recompute their activations in
+        the backward pass instead of keeping them (see activation_checkpointing.py). The BoW prior has no blocks.
+        GPT2 then returns no key/value cache: a checkpointed block would keep it alive, and recompute it, for nothing.
+        '''
+        if 'gpt2' in submodules:
+            self.gpt2_model.config.use_cache = False
+            checkpoint_blocks(self.gpt2_model.transformer.h)
+        for name, model in [('prior', self.prior_model), ('posterior', self.inference_model)]:
+            if name in submodules and hasattr(model, 'roberta_model'):
+                checkpoint_blocks(model.roberta_model.base_model.encoder.layer)
+
+    def freeze_unused_parameters(self):
+        '''
+        requires_grad=False on the parameters that the training loss never reaches, so that DDP needs no
+        find_unused_parameters graph traversal and nothing is all-reduced or updated for them: the classification
+        heads of the encoders (only the <s> encodings are used), the multiple-choice head (loss_mc is always 0)
+        and, when marginalizing, the inference network, which is not run.
+        '''
+        unused = [self.gpt2_model.multiple_choice_head]
+        for model in (self.prior_model, self.inference_model):
+            if getattr(getattr(model, 'roberta_model', None), 'classifier', None) is not None:
+                unused.append(model.roberta_model.classifier)
+        if self.training_type == TRAINING_TYPE_MARGINALIZE:
+            unused.append(self.inference_model)
+        for module in unused:
+            module.requires_grad_(False)
+
+    def log_likelihood(self, input_ids, token_type_ids, mc_token_ids, lm_labels, return_logits=False):
+        '''
+        input_ids, token_type_ids, lm_labels: N x ... x T
+        mc_token_ids: N x ...
+        returns log p(x|z,H) summed over the labelled tokens of every row: N, the lm logits (None unless return_logits)
+        and the mc logits
+
+        The LM head is applied only to the hidden states that predict a labelled token, so the vocabulary
+        projection costs O(reply x V) instead of O(T x V).
+        With `chunked_ce_size` > 0 the reply logits are never materialized either: the cross-entropy is computed
+        over blocks of the vocabulary (see losses.py), and instead of the lm logits return_logits gives the token
+        statistics N x ... x (T - 1) x 2: (nll, entropy) of every labelled position, NaN elsewhere.
+        With `pack_length` > 0, training sequences are packed into rows first (see packed_log_likelihood).
+        '''
+        if self.pack_length > 0 and not return_logits:
+            return self.packed_log_likelihood(input_ids, token_type_ids, mc_token_ids, lm_labels)
+        hidden_states = self.gpt2_model.transformer(input_ids, token_type_ids=token_type_ids)[0]  # N x ... x T x H
+        mc_logits = self.gpt2_model.multiple_choice_head(hidden_states, mc_token_ids).squeeze(-1)
+
+        lm_labels_shifted = lm_labels[..., 1:]
+        labelled = lm_labels_shifted != -100
+        labelled_hidden_states = hidden_states[..., :-1, :][labelled]  # M x H
+        ll_tokens = self.token_log_likelihood(labelled_hidden_states, lm_labels_shifted[labelled])  # M
+        row_index = torch.arange(labelled.shape[0], device=labelled.device)
+        row_index = row_index.view((-1,) + (1,) * (labelled.dim() - 1)).expand_as(labelled)[labelled]  # M
+        ll_lm = torch.zeros(labelled.shape[0], dtype=ll_tokens.dtype, device=ll_tokens.device)
+        ll_lm = ll_lm.index_add(0, row_index, ll_tokens)  # N
+
+        if not return_logits:
+            lm_logits = None
+        elif self.chunked_ce_size > 0:
+            token_entropy = chunked_entropy(
+                labelled_hidden_states, self.gpt2_model.lm_head.weight.to(labelled_hidden_states.dtype), self.chunked_ce_size)
+            lm_logits = torch.full(labelled.shape + (2,), float('nan'), dtype=token_entropy.dtype, device=token_entropy.device)
+            lm_logits[labelled] = torch.stack([-ll_tokens.float(), token_entropy], dim=-1)
+        else:
+            lm_logits = self.gpt2_model.lm_head(hidden_states)
+        return ll_lm, lm_logits, mc_logits
+
+    def token_log_likelihood(self, hidden_states, labels):
+        '''
+        hidden_states: M x H, the states that predict the labels: M
+        returns log p of every label: M
+        '''
+        if self.chunked_ce_size > 0:
+            # same dtype for both under autocast: the backward pass runs outside of it
+            weight = self.gpt2_model.lm_head.weight.to(hidden_states.dtype)
+            return -1 * chunked_cross_entropy(hidden_states, weight, labels, self.chunked_ce_size)
+        return -1 * self.criterion_lm(self.gpt2_model.lm_head(hidden_states).float(), labels)  # fp32 loss under autocast
+
+    def packed_log_likelihood(self, input_ids, token_type_ids, mc_token_ids, lm_labels):
+        '''
+        log_likelihood with the N x ... right-padded sequences packed into rows of `pack_length` tokens.
+        Positions restart and attention is block-diagonal per sequence, so every sequence sees exactly what it
+        sees unpacked; the log-likelihoods are summed back per sequence and per row. GPT2 only.
+        returns log p(x|z,H): N, None and the mc logits: N x ...
+        '''
+        num_rows, sequence_shape = input_ids.shape[0], input_ids.shape[:-1]
+        flat = lambda t: t.reshape(-1, t.shape[-1])  # S x T
+        lengths = mc_token_ids.reshape(-1) + 1  # the mc token is the last one of every sequence
+        packed_batch = PackedBatch(lengths, self.pack_length)
+        hidden_states = packed_gpt2_hidden_states(
+            self.gpt2_model.transformer, packed_batch, packed_batch.pack(flat(input_ids), 0), packed_batch.pack(flat(token_type_ids), 0))
+
+        lm_labels = flat(lm_labels).clone()
+        lm_labels[:, 0] = -100  # the last token of a sequence must not predict the first one of the next
+        lm_labels_shifted = packed_batch.pack(lm_labels, -100)[:, 1:]
+        labelled = lm_labels_shifted != -100
+        ll_tokens = self.token_log_likelihood(hidden_states[:, :-1][labelled], lm_labels_shifted[labelled])  # M
+        ll_sequences = torch.zeros(packed_batch.num_sequences, dtype=ll_tokens.dtype, device=ll_tokens.device)
+        ll_sequences = ll_sequences.index_add(0, packed_batch.document[:, 1:][labelled], ll_tokens)  # S
+        ll_lm = ll_sequences.view(num_rows, -1).sum(1)  # N
+
+        mc_hidden_states = hidden_states[packed_batch.sequence_row, packed_batch.sequence_offset + lengths - 1]  # S x H
+        mc_logits = self.gpt2_model.multiple_choice_head(
+            mc_hidden_states.unsqueeze(1), torch.zeros_like(lengths)).squeeze(-1)
+        return ll_lm, None, mc_logits.view(sequence_shape)
+
+    def log_likelihood_selected(self, index, input_ids, token_type_ids, mc_token_ids, lm_labels):
+        '''
+        index: B x K, personas to evaluate for every example
+        input_ids, token_type_ids, lm_labels: B x P x C x T
+        mc_token_ids: B x P x C
+        returns log p(x|z,H) of the chosen personas: B x K, their lm logits: B x K x C x T x V (None when training,
+        token statistics B x K x C x (T - 1) x 2 with `chunked_ce_size`) and their mc logits: B x K x C
+        All B x K sequences go through GPT2 in a single batched pass. index is kept as selected_personas, so that
+        the evaluation can score the returned logits against the labels of the same personas.
+        '''
+        batch_size, num_selected = index.shape
+        self.selected_personas = index
+        with self.stage_timer.stage('sample', self.training):
+            selected = [select_personas(t, index).reshape((-1,) + t.shape[2:]) for t in (input_ids, token_type_ids, mc_token_ids, lm_labels)]
+        with self.stage_timer.stage('gpt2', self.training):
+            ll_lm, lm_logits, mc_logits = self.log_likelihood(*selected, return_logits=not self.training)
+        if lm_logits is not None:
+            lm_logits = lm_logits.view((batch_size, num_selected) + lm_logits.shape[1:])
+        return ll_lm.view(batch_size, num_selected), lm_logits, mc_logits.view((batch_size, num_selected) + mc_logits.shape[1:])
+
+    @staticmethod
+    def first_selected(lm_logits):
+        return lm_logits[:, :1] if lm_logits is not None else None
+
+    def _chunk_log_likelihood(self, input_ids, token_type_ids, mc_token_ids, lm_labels):
+        return self.log_likelihood(input_ids, token_type_ids, mc_token_ids, lm_labels)[0]
+
+    def log_likelihood_all_personas(self, input_ids, token_type_ids, mc_token_ids, lm_labels):
+        '''
+        input_ids, token_type_ids, lm_labels: B x P x C x T
+        mc_token_ids: B x P x C
+        returns log p(x|z,H) for every persona: B x P
+
+        Personas are folded into the batch `marginalize_chunk_size` at a time, so at most B x chunk GPT2 sequences
+        are alive at once. When training, every chunk is checkpointed: only its B x chunk log-likelihoods are kept
+        and its activations are recomputed in the backward pass, so memory stays bounded by the chunk size.
+        '''
+        batch_size, num_personas = input_ids.shape[:2]
+        chunk_size = self.marginalize_chunk_size if self.marginalize_chunk_size > 0 else num_personas
+        log_likelihoods = []
+        for start in range(0, num_personas, chunk_size):
+            # contiguous: a chunk of one persona would otherwise fold into a view that GPT2's .view() rejects
+            chunk = [t[:, start:start + chunk_size].contiguous() for t in (input_ids, token_type_ids, mc_token_ids, lm_labels)]
+            num_chunk_personas = chunk[0].shape[1]
+            chunk = [t.reshape((-1,) + t.shape[2:]) for t in chunk]  # (B * chunk) x ...
+            if self.training:
+                ll_lm = checkpoint(self._chunk_log_likelihood, *chunk, use_reentrant=False)
+            else:
+                ll_lm = self._chunk_log_likelihood(*chunk)
+            log_likelihoods.append(ll_lm.view(batch_size, num_chunk_personas))
+        return torch.cat(log_likelihoods, dim=1)  # B x P
+
     def compute_kl_loss(self, posterior, prior):
         # TODO: can get numerically unstable
         log_posterior = torch.log(posterior) # BS * P
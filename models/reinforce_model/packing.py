@@ -0,0 +1,90 @@
+import torch
+
+
+def plan_packing(lengths, pack_length):
+    '''
+    lengths: list with the number of real tokens of every sequence
+    returns the row of every sequence and its offset in that row, packing first-fit decreasing into rows of
+    pack_length tokens (or of the longest sequence, if it does not fit), and the number of rows
+    '''
+    capacity = max(pack_length, max(lengths))
+    rows, offsets = [0] * len(lengths), [0] * len(lengths)
+    row_fill = []
+    for s in sorted(range(len(lengths)), key=lambda s: -lengths[s]):
+        for r, fill in enumerate(row_fill):
+            if fill + lengths[s] <= capacity:
+                break
+        else:
+            r = len(row_fill)
+            row_fill.append(0)
+        rows[s], offsets[s] = r, row_fill[r]
+        row_fill[r] += lengths[s]
+    return rows, offsets, len(row_fill), capacity
+
+
+class PackedBatch:
+    '''
+    S right-padded sequences of length T packed into R rows of L tokens. Every token remembers its sequence, so
+    that the packed outputs can be unpacked per sequence.
+    '''
+
+    def __init__(self, lengths, pack_length):
+        '''
+        lengths: S, number of real tokens of every sequence
+        '''
+        device = lengths.device
+        rows, offsets, self.num_rows, self.row_length = plan_packing(lengths.tolist(), pack_length)
+        self.sequence_row = torch.tensor(rows, device=device)  # S
+        self.sequence_offset = torch.tensor(offsets, device=device)  # S
+        self.num_sequences = len(lengths)
+        self.seq_index = torch.repeat_interleave(torch.arange(self.num_sequences, device=device), lengths)  # total tokens
+        self.token_index = torch.arange(len(self.seq_index), device=device) - \
+            torch.repeat_interleave(torch.cumsum(lengths, 0) - lengths, lengths)
+        self.row_index = self.sequence_row[self.seq_index]
+        self.col_index = self.sequence_offset[self.seq_index] + self.token_index
+        # sequence of every packed position, -1 on the padding at the end of the rows: R x L
+        self.document = self.scatter(self.seq_index, -1)
+
+    def scatter(self, values, fill_value):
+        '''
+        values: total tokens, returns them at their packed positions: R x L, fill_value elsewhere
+        '''
+        packed = torch.full((self.num_rows, self.row_length), fill_value, dtype=values.dtype, device=values.device)
+        packed[self.row_index, self.col_index] = values
+        return packed
+
+    def pack(self, padded, fill_value):
+        '''
+        padded: S x T, returns R x L
+        '''
+        return self.scatter(padded[self.seq_index, self.token_index], fill_value)
+
+    def position_ids(self):
+        ''' positions restart at 0 with every sequence: R x L '''
+        return self.scatter(self.token_index, 0)
+
+    def attention_mask(self, dtype):
+        '''
+        Additive mask R x 1 x L x L: a token only attends to the previous tokens of its own sequence.
+        '''
+        same_document = self.document.unsqueeze(2) == self.document.unsqueeze(1)
+        causal = torch.ones(self.row_length, self.row_length, dtype=torch.bool, device=self.document.device).tril()
+        allowed = same_document & causal
+        return (~allowed).to(dtype).unsqueeze(1) * -10000.0
+
+    def utilization(self):
+        return len(self.seq_index) / float(self.num_rows * self.row_length)
+
+
+def packed_gpt2_hidden_states(transformer, packed_batch, input_ids, token_type_ids):
+    '''
+    GPT2 transformer over packed rows, with per-sequence positions and attention.
+    input_ids, token_type_ids: R x L (packed)
+    returns the final hidden states: R x L x H
+    '''
+    hidden_states = transformer.wte(input_ids) + transformer.wpe(packed_batch.position_ids()) + transformer.wte(token_type_ids)
+    hidden_states = transformer.drop(hidden_states)
+    attention_mask = packed_batch.attention_mask(hidden_states.dtype)
+    for block in transformer.h:
+        hidden_states = block(hidden_states, attention_mask=attention_mask)[0]
+    return transformer.ln_f(hidden_states)
@@ -0,0 +1,89 @@
+import time
+import threading
+from queue import Queue, Full
+
+import torch
+
+_END = object()
+
+
+class DevicePrefetcher:
+    '''
+    Iterates a DataLoader of batch dicts and returns them already on device. A background thread collates the next
+    batches and copies them (pinned, non_blocking, on a side CUDA stream) while the current step runs; the step's
+    stream waits for the copy only when the batch is used. data_wait is how long the last batch kept the training
+    loop waiting, in seconds, and h2d how long its copy took in the background (with time_copies, the thread waits
+    for the copy to finish to measure it, otherwise it is only the time to issue it). The other attributes
+    (sampler, dataset, ...) are the DataLoader's.
+    '''
+
+    def __init__(self, loader, device, depth=2, time_copies=False):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+        self.time_copies = time_copies
+        self.data_wait = 0.0
+        self.h2d = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.__dict__['loader'], name)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        # a generator: nothing is fetched before the first next(), so a sampler's set_epoch at the start of an
+        # epoch still applies
+        queue, stop = Queue(maxsize=self.depth), threading.Event()
+        threading.Thread(target=self._stage, args=(queue, stop), daemon=True).start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = queue.get()
+                self.data_wait = time.perf_counter() - start
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                batch, copied, self.h2d = item
+                if copied is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(copied)
+                    for input_tensor in batch.values():
+                        input_tensor.record_stream(stream)  # allocated on the side stream, used on this one
+                yield batch
+        finally:
+            stop.set()
+
+    def _stage(self, queue, stop):
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.loader:
+                copied = None
+                start = time.perf_counter()
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = {name: (input_tensor if input_tensor.is_pinned() else input_tensor.pin_memory())
+                                 .to(self.device, non_blocking=True) for name, input_tensor in batch.items()}
+                        copied = torch.cuda.Event()
+                        copied.record(stream)
+                    if self.time_copies:
+                        copied.synchronize()
+                else:
+                    batch = {name: input_tensor.to(self.device) for name, input_tensor in batch.items()}
+                if not self._put(queue, (batch, copied, time.perf_counter() - start), stop):
+                    return
+            self._put(queue, _END, stop)
+        except Exception as e:
+            self._put(queue, e, stop)
+
+    @staticmethod
+    def _put(queue, item, stop):
+        ''' False if the iteration was abandoned before item could be queued '''
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
@@ -1,4 +1,7 @@
-from transformers import RobertaForSequenceClassification
+import copy
+from contextlib import contextmanager
+
+from transformers import AutoConfig, AutoModelForSequenceClassification, RobertaConfig, RobertaForSequenceClassification
 
 import torch
 import torch.nn as nn
@@ -6,10 +9,159 @@ import torch.nn.functional as F
 from models.reinforce_model.dataset import EFFECTS
 
 
+ENCODER_TINY = 'tiny'
+# small random RoBERTa for tests; keeps the vocabulary and positions of roberta-base
+TINY_ENCODER_CONFIG = dict(vocab_size=50265, hidden_size=64, num_hidden_layers=2, num_attention_heads=2,
+                           intermediate_size=128, max_position_embeddings=514, pad_token_id=1, type_vocab_size=1)
+
+
+@contextmanager
+def skip_init_weights():
+    '''
+    Modules built inside are not randomly initialized, for weights that a checkpoint overwrites anyway
+    (a no-op on transformers versions without no_init_weights)
+    '''
+    try:
+        from transformers.modeling_utils import no_init_weights
+    except ImportError:
+        yield
+        return
+    with no_init_weights():
+        yield
+
+
+def load_encoder(args, pretrained=True, encoder_cache=None):
+    '''
+    The sequence classification model whose body encodes personas, history and responses: `encoder_model`
+    ('roberta-base' by default, any HF checkpoint or local path with RoBERTa's vocabulary since the inputs are
+    GPT2/RoBERTa BPE ids, or 'tiny' for a small random one), cut to its first `encoder_num_layers` layers (<=0: all).
+
+    pretrained=False builds the architecture from the config only, for a model whose checkpoint is loaded next.
+    encoder_cache (a dict shared by the submodules of one model) makes every distinct backbone load only once;
+    later requests get a copy, so that the submodules still train separate weights.
+    '''
+    encoder_model = getattr(args, 'encoder_model', 'roberta-base')
+    num_layers = getattr(args, 'encoder_num_layers', 0)
+    key = (encoder_model, num_layers, pretrained)
+    if encoder_cache is not None and key in encoder_cache:
+        return copy.deepcopy(encoder_cache[key])
+
+    if encoder_model == ENCODER_TINY:
+        config = RobertaConfig(**TINY_ENCODER_CONFIG)
+    else:
+        config = AutoConfig.from_pretrained(encoder_model)
+    if num_layers > 0:
+        config.num_hidden_layers = num_layers  # only the weights of the first layers are loaded
+    if encoder_model == ENCODER_TINY:
+        encoder = RobertaForSequenceClassification(config)
+    elif pretrained:
+        encoder = AutoModelForSequenceClassification.from_pretrained(encoder_model, config=config)
+    else:
+        with skip_init_weights():
+            encoder = AutoModelForSequenceClassification.from_config(config)
+
+    if encoder_cache is not None:
+        encoder_cache[key] = encoder
+    return encoder
+
+
+def encode_cls(roberta_model, input_ids, attention_mask=None):
+    '''
+    Final-layer <s> encoding: N x 764
+    Runs only the encoder body, so the classification head is skipped and no intermediate hidden states are returned.
+    Returned in fp32 under autocast, so that the distances between encodings are not computed in half precision.
+    '''
+    return roberta_model.base_model(input_ids, attention_mask=attention_mask)[0][:, 0, :].float()
+
+
+def encode_sequences(roberta_model, input_ids, lengths=None, bucket_size=0):
+    '''
+    input_ids: N x T (right padded)
+    lengths: N, number of real tokens in every row
+    Returns the final-layer <s> encoding of every row: N x 764
+
+    Rows are sorted by length and encoded in buckets which are cut to the longest row of the
+    bucket, with an attention mask over the padding that is left. Padding therefore gets
+    (almost) no compute and does not change the encodings. Results come back in the original row order.
+    '''
+    if lengths is None:
+        return encode_cls(roberta_model, input_ids)
+
+    num_rows = input_ids.shape[0]
+    if bucket_size <= 0:
+        bucket_size = num_rows
+    lengths = lengths.to(input_ids.device).clamp(min=1)  # fully padded rows still get their first token encoded
+    sorted_lengths, order = torch.sort(lengths, descending=True)
+    bucket_lengths = sorted_lengths[::bucket_size].tolist()  # one host sync for all buckets
+
+    encodings = []
+    for bucket_idx, start in enumerate(range(0, num_rows, bucket_size)):
+        rows = order[start:start + bucket_size]
+        max_len = bucket_lengths[bucket_idx]
+        attention_mask = torch.arange(max_len, device=input_ids.device).unsqueeze(0) \
+            < sorted_lengths[start:start + bucket_size].unsqueeze(1)
+        encodings.append(encode_cls(roberta_model, input_ids[rows, :max_len], attention_mask.long()))
+    return torch.cat(encodings)[torch.argsort(order)]
+
+
+def unique_rows(input_ids, lengths, pad_id):
+    '''
+    input_ids: N x T, lengths: N
+    Returns the distinct rows: U x T, their lengths: U, and the index of every row among them: N
+    Tokens past the length of a row are ignored.
+    '''
+    input_ids = input_ids.masked_fill(torch.arange(input_ids.shape[1], device=input_ids.device) >= lengths.unsqueeze(1), pad_id)
+    unique_input_ids, inverse = torch.unique(torch.cat([lengths.unsqueeze(1), input_ids], dim=1), dim=0, return_inverse=True)
+    return unique_input_ids[:, 1:], unique_input_ids[:, 0], inverse
+
+
+def encode_sequence_groups(roberta_model, groups, bucket_size=0, dedup=False):
+    '''
+    groups: list of (input_ids: N_i x T_i right padded, lengths: N_i or None for rows without padding)
+    Returns the final-layer <s> encodings of every group: [N_i x 764], and the number of rows actually encoded
+
+    All rows go through a single encode_sequences call: they are padded to a common length, concatenated,
+    encoded in length-sorted buckets and split again. Small groups (e.g. B history rows) then share
+    batches with the persona rows instead of getting encoder calls of their own.
+    With dedup, identical rows (e.g. a persona shared by several turns of a dialog) are encoded once and
+    their encoding is scattered back to every occurrence.
+    '''
+    max_len = max(input_ids.shape[1] for input_ids, _ in groups)
+    pad_id = roberta_model.config.pad_token_id
+    all_input_ids, all_lengths = [], []
+    for input_ids, lengths in groups:
+        all_input_ids.append(F.pad(input_ids, (0, max_len - input_ids.shape[1]), value=pad_id))
+        if lengths is None:
+            lengths = torch.full((input_ids.shape[0],), input_ids.shape[1], dtype=torch.long, device=input_ids.device)
+        all_lengths.append(lengths.to(input_ids.device))
+    all_input_ids, all_lengths = torch.cat(all_input_ids), torch.cat(all_lengths)
+    if dedup:
+        all_input_ids, all_lengths, inverse = unique_rows(all_input_ids, all_lengths, pad_id)
+    encodings = encode_sequences(roberta_model, all_input_ids, all_lengths, bucket_size)
+    num_encoded = encodings.shape[0]
+    if dedup:
+        encodings = encodings[inverse]
+    return list(torch.split(encodings, [input_ids.shape[0] for input_ids, _ in groups])), num_encoded
+
+
+class BoWPriorState:
+    '''
+    Incremental state of PriorBoWModel over the turns of one dialog (see get_prob_z_given_H_incremental):
+    the persona mean embeddings, and the history tokens embedded so far with the sum of their embeddings.
+    '''
+
+    def __init__(self):
+        self.persona = None  # B x P x T, the personas the encodings belong to
+        self.persona_encodings = None  # B x P x 764
+        self.history = None  # B x T, without <s>
+        self.history_sum = None  # B x 764
+        self.num_history_positions = None  # B, non-padding history tokens, for the positions of the next ones
+        self.num_recomputed = 0  # calls that had to embed the whole history
+
 
 class PriorBoWModel(nn.Module):
 
-    def __init__(self, args):
+    def __init__(self, args, pretrained=True, encoder_cache=None):
         super().__init__()
         self.args = args
         self.uniform_prior = args.uniform_prior
@@ -18,8 +170,9 @@ class PriorBoWModel(nn.Module):
         self.use_structured_prior_binarypotential = args.use_structured_prior_binarypotential
 
         if not self.uniform_prior:
-            self.roberta_embeddings = RobertaForSequenceClassification.from_pretrained('roberta-base').roberta.embeddings
-            self.hidden_size = RobertaForSequenceClassification.from_pretrained('roberta-base').config.hidden_size
+            encoder = load_encoder(args, pretrained, encoder_cache)
+            self.roberta_embeddings = encoder.base_model.embeddings
+            self.hidden_size = encoder.config.hidden_size
             self.history_tranformation = nn.Linear(self.hidden_size, self.hidden_size)
         else:
             assert not self.entropy_regularize_prior_wt>0. # Doesn't make sense with uniform prior
@@ -38,10 +191,11 @@ class PriorBoWModel(nn.Module):
                 self.num_feats += 1
             self.feature_combiner = nn.Parameter(torch.rand(self.num_feats).to(self.args.device))
 
-    def get_prob_z_given_H(self, persona, history, effects=None):
+    def get_prob_z_given_H(self, persona, history, effects=None, persona_length=None, history_length=None):
         '''
         persona: B x P x T
         H: B x T
+        persona_length, history_length: unused, the bag of embeddings is taken over the padded rows
 
         We take the pooled output from Roberta; which uses same tokenization as GPT2
         '''
@@ -56,35 +210,88 @@ class PriorBoWModel(nn.Module):
 
         else:
             history_encodings = self.roberta_embeddings(history).mean(dim=1)  # B x 764
-            history_encodings = self.history_tranformation(history_encodings) # B x 764
-            history_encodings = history_encodings.unsqueeze(1).repeat(1, persona.shape[1], 1)  # B x P x 764
+            return self.prob_z_given_encodings(history_encodings, self.encode_personas(persona), effects)
 
-            batch_size, num_personas, num_tokens = persona.shape
-            persona = persona.reshape(-1, num_tokens)
-            persona_encodings = self.roberta_embeddings(persona).mean(dim=1).reshape(batch_size, num_personas, -1)
+    def encode_personas(self, persona):
+        '''
+        persona: B x P x T, without <s>
+        returns the mean embedding of every persona: B x P x 764
+        '''
+        batch_size, num_personas, num_tokens = persona.shape
+        persona = persona.reshape(-1, num_tokens)
+        return self.roberta_embeddings(persona).mean(dim=1).reshape(batch_size, num_personas, -1)
 
+    def embed_history_tokens(self, history, num_previous_positions):
+        '''
+        history: B x T, tokens that follow num_previous_positions: B non-padding history tokens
+        returns the sum of their embeddings: B x 764, and the number of non-padding tokens among them: B
+        Positions continue those of the previous tokens, so the sums of consecutive pieces add up to the
+        sum over the whole history.
+        '''
+        padding_idx = self.roberta_embeddings.padding_idx
+        mask = history.ne(padding_idx).long()
+        position_ids = (torch.cumsum(mask, dim=1) + num_previous_positions.unsqueeze(1)) * mask + padding_idx
+        return self.roberta_embeddings(history, position_ids=position_ids).sum(dim=1), mask.sum(dim=1)
 
-            feats = -1.0 * torch.norm(history_encodings - persona_encodings, 2, dim=-1)
-            # print("feats : ", feats.size())
+    def get_prob_z_given_H_incremental(self, persona, history, effects, state):
+        '''
+        get_prob_z_given_H for successive turns of a dialog, updating `state` (a BoWPriorState) in place.
+        The persona encodings are reused as long as the personas do not change, and when the history extends
+        the previous one only the new tokens are embedded. Any other history (e.g. once the max_history window
+        starts to slide) is embedded from scratch.
+        '''
+        if self.uniform_prior:
+            return self.get_prob_z_given_H(persona, history, effects)
+
+        if state.persona is None or not torch.equal(state.persona, persona):
+            state.persona = persona
+            state.persona_encodings = self.encode_personas(persona[..., 1:])
+
+        history = history[..., 1:]  # remove <s> token
+        num_previous = 0 if state.history is None else state.history.shape[1]
+        if state.history is None or num_previous > history.shape[1] or not torch.equal(history[:, :num_previous], state.history):
+            state.num_recomputed += 1
+            no_positions = torch.zeros(history.shape[0], dtype=torch.long, device=history.device)
+            state.history_sum, state.num_history_positions = self.embed_history_tokens(history, no_positions)
+        elif history.shape[1] > num_previous:
+            new_sum, num_new_positions = self.embed_history_tokens(history[:, num_previous:], state.num_history_positions)
+            state.history_sum = state.history_sum + new_sum
+            state.num_history_positions = state.num_history_positions + num_new_positions
+        state.history = history
+
+        history_encodings = state.history_sum / history.shape[1]  # the mean over the padded history, as above
+        return self.prob_z_given_encodings(history_encodings, state.persona_encodings, effects)
+
+    def prob_z_given_encodings(self, history_encodings, persona_encodings, effects=None):
+        '''
+        history_encodings: B x 764, mean history embeddings
+        persona_encodings: B x P x 764
+        returns: B x P
+        '''
+        history_encodings = self.history_tranformation(history_encodings) # B x 764
+        history_encodings = history_encodings.unsqueeze(1).repeat(1, persona_encodings.shape[1], 1)  # B x P x 764
+
+        feats = -1.0 * torch.norm(history_encodings - persona_encodings, 2, dim=-1)
+        # print("feats : ", feats.size())
 
-            if self.use_structured_prior:
-                embs = self.effect_type_emb(effects) # B,P,emsize
-                effect_feature = self.effect_type_to_feature(embs) # B,P,1
-                # print(torch.exp(effect_feature, dim=-1)) --> sort and analyze
-                # print("feats : ", feats.size())
-                # print("effect_feature : ", effect_feature.size())
-                if self.use_structured_prior_binarypotential:
-                    effecthistory_feature = self.effecthistory_type_to_feature(
-                        torch.cat([embs,history_encodings],dim=2)) # B,P,1
-                    feats = torch.cat([feats.unsqueeze(2), effect_feature,effecthistory_feature], dim=2)  # B,P,num_feats
-                else:
-                    feats = torch.cat([feats.unsqueeze(2), effect_feature], dim=2)  # B,P,num_feats
-                feats = torch.sum( feats * self.feature_combiner.unsqueeze(0).unsqueeze(0), dim=2)
-
-            prob_z_given_H = F.softmax(feats, dim=-1)
-            # print("prob_z_given_H : ", prob_z_given_H.size())
-            ret = prob_z_given_H # B x P
-            return ret
+        if self.use_structured_prior:
+            embs = self.effect_type_emb(effects) # B,P,emsize
+            effect_feature = self.effect_type_to_feature(embs) # B,P,1
+            # print(torch.exp(effect_feature, dim=-1)) --> sort and analyze
+            # print("feats : ", feats.size())
+            # print("effect_feature : ", effect_feature.size())
+            if self.use_structured_prior_binarypotential:
+                effecthistory_feature = self.effecthistory_type_to_feature(
+                    torch.cat([embs,history_encodings],dim=2)) # B,P,1
+                feats = torch.cat([feats.unsqueeze(2), effect_feature,effecthistory_feature], dim=2)  # B,P,num_feats
+            else:
+                feats = torch.cat([feats.unsqueeze(2), effect_feature], dim=2)  # B,P,num_feats
+            feats = torch.sum( feats * self.feature_combiner.unsqueeze(0).unsqueeze(0), dim=2)
+
+        prob_z_given_H = F.softmax(feats, dim=-1)
+        # print("prob_z_given_H : ", prob_z_given_H.size())
+        ret = prob_z_given_H # B x P
+        return ret
 
     def sample(self, dist_over_z):
         '''
@@ -109,18 +316,24 @@ class PriorBoWModel(nn.Module):
 class PriorRobertaModel(nn.Module):
 
     def __init__(self,
-                 args):
+                 args,
+                 pretrained=True,
+                 encoder_cache=None):
         super().__init__()
         self.args = args
         self.uniform_prior = args.uniform_prior
+        self.encoder_bucket_size = getattr(args, 'encoder_bucket_size', 0)
+        self.dedup_personas = getattr(args, 'dedup_personas', False)
+        self.dedup_ratio = 0.0  # share of the rows of the last call that were not encoded thanks to deduplication
         if not self.uniform_prior:
-            self.roberta_model = RobertaForSequenceClassification.from_pretrained('roberta-base', output_hidden_states=True)
+            self.roberta_model = load_encoder(args, pretrained, encoder_cache)
 
 
-    def get_prob_z_given_H(self, persona, history, effects=None):
+    def get_prob_z_given_H(self, persona, history, effects=None, persona_length=None, history_length=None):
         '''
         persona: B x P x T
         H: B x T
+        persona_length: B x P, history_length: B (optional, padding is attended to without them)
         We take the pooled output from Roberta; which uses same tokenization as GPT2
         TODO: Add <s> token at the beginning which will act as [CLS] token in BERT
         '''
@@ -133,12 +346,17 @@ class PriorRobertaModel(nn.Module):
 
         else:
             # print("history.shape, persona.shape:", history.shape, persona.shape)
-            history_encodings = self.roberta_model(history)[1][-1][:, 0, :]  # B x 764
-            history_encodings = history_encodings.unsqueeze(1).repeat(1, persona.shape[1], 1)  # B x P x 764
             batch_size, num_personas, num_tokens = persona.shape
             persona = persona.reshape(-1, num_tokens)
+            if persona_length is not None:
+                persona_length = persona_length.reshape(-1)
             # print("persona.shape:", persona.shape)
-            persona_encodings = self.roberta_model(persona)[1][-1][:, 0, :].reshape(batch_size, num_personas, -1)
+            (history_encodings, persona_encodings), num_encoded = encode_sequence_groups(
+                self.roberta_model, [(history, history_length), (persona, persona_length)], self.encoder_bucket_size,
+                self.dedup_personas)
+            self.dedup_ratio = 1.0 - num_encoded / float(history.shape[0] + persona.shape[0])
+            history_encodings = history_encodings.unsqueeze(1).repeat(1, num_personas, 1)  # B x P x 764
+            persona_encodings = persona_encodings.reshape(batch_size, num_personas, -1)
 
             norms = -1.0 * torch.norm(history_encodings - persona_encodings, 2, dim=-1)
             prob_z_given_H = F.softmax(norms, dim=-1)
@@ -168,19 +386,24 @@ class PriorRobertaModel(nn.Module):
 class InferenceRobertaModel(nn.Module):
 
     def __init__(self,
-                 args):
+                 args,
+                 pretrained=True,
+                 encoder_cache=None):
         super().__init__()
         self.args = args
         self.uniform_prior = args.uniform_prior
+        self.encoder_bucket_size = getattr(args, 'encoder_bucket_size', 0)
+        self.dedup_personas = getattr(args, 'dedup_personas', False)
+        self.dedup_ratio = 0.0  # share of the rows of the last call that were not encoded thanks to deduplication
         if not self.uniform_prior:
-            self.roberta_model = RobertaForSequenceClassification.from_pretrained('roberta-base',
-                                                                                  output_hidden_states=True)
+            self.roberta_model = load_encoder(args, pretrained, encoder_cache)
         self.use_history = False # TODO - add to args
 
-    def get_prob_z_given_H_and_x(self, mc_token_ids, persona, history, effects=None):
+    def get_prob_z_given_H_and_x(self, mc_token_ids, persona, history, effects=None, persona_length=None, history_length=None):
         '''
         persona: B x P x T
         H: B x T
+        persona_length: B x P, history_length: B (optional, padding is attended to without them)
         We take the pooled output from Roberta; which uses same tokenization as GPT2
         TODO: Add <s> token at the beginning which will act as [CLS] token in BERT
         '''
@@ -196,27 +419,36 @@ class InferenceRobertaModel(nn.Module):
 
             # print("history.shape, persona.shape, gt_response.shape:", history.shape, persona.shape, gt_response.shape)
             if self.use_history:
-                history_encodings = self.roberta_model(history)[1][-1][:, 0, :]  # B x 764
+                history_encodings = encode_sequences(
+                    self.roberta_model, history, history_length, self.encoder_bucket_size)  # B x 764
                 history_encodings = history_encodings.unsqueeze(1).repeat(1, persona.shape[1], 1)  # B x P x 764
 
-            gt_response_encodings = self.roberta_model(gt_response)[1][-1][:, 0, :]  # B x 764
-
             batch_size, num_personas, num_tokens = persona.shape
             persona = persona.reshape(-1, num_tokens)
+            if persona_length is not None:
+                persona_length = persona_length.reshape(-1)
             # print("persona.shape:", persona.shape)
-            persona_encodings = self.roberta_model(persona)[1][-1][:, 0, :].reshape(batch_size, num_personas, -1)
+            (gt_response_encodings, persona_encodings), num_encoded = encode_sequence_groups(
+                self.roberta_model, [(gt_response, None), (persona, persona_length)], self.encoder_bucket_size,
+                self.dedup_personas)  # B x 764
+            self.dedup_ratio = 1.0 - num_encoded / float(gt_response.shape[0] + persona.shape[0])
+            persona_encodings = persona_encodings.reshape(batch_size, num_personas, -1)
             if self.use_history:
                     raise NotImplementedError
             norms = -1.0 * torch.norm(gt_response_encodings - persona_encodings, 2, dim=-1)
             prob_z_given_H_and_x = F.softmax(norms, dim=-1)
             return prob_z_given_H_and_x  # B x P
 
-    def sample(self, dist_over_z):
+    def sample(self, dist_over_z, num_samples=1):
         '''
         :param dist_over_z: B,prior_size
+        :param num_samples: actions to draw per example; with more than one, action and logprob are B,num_samples
         :return: action, logprob of chosen action
         '''
         dist: torch.distributions.Categorical = torch.distributions.Categorical(logits=dist_over_z)
+        if num_samples > 1:
+            action_idx = dist.sample((num_samples,))  # num_samples;B
+            return action_idx.T, dist.log_prob(action_idx).T  # B,num_samples;B,num_samples
         action_idx = dist.sample()  # B
         return action_idx, dist.log_prob(action_idx)  # B;B
 
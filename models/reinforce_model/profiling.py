@@ -0,0 +1,125 @@
+import os
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+import torch
+from ignite.engine import Events
+
+STAGES = ['data_wait', 'h2d', 'posterior', 'prior', 'sample', 'gpt2', 'loss', 'backward', 'clip', 'optimizer']
+MODEL_STAGES = ['posterior', 'prior', 'sample', 'gpt2']
+_DISABLED = nullcontext()
+
+
+class StageTimer:
+    '''
+    Wall time of the stages of a training step (STAGES), summed until pop(). On CUDA every stage synchronizes
+    before and after, so that its kernels are counted in it and not in the next one; this slows the step down, so
+    it is only done when enabled. Disabled, stage() returns a shared no-op context and add() returns at once.
+    '''
+
+    def __init__(self, enabled=False, device='cpu'):
+        self.enabled = enabled
+        self.cuda = enabled and torch.device(device).type == 'cuda'
+        self.times = defaultdict(float)
+
+    def stage(self, name, active=True):
+        ''' active=False: not timed either (e.g. the model's forward in evaluation, whose model shares the timer) '''
+        if not (self.enabled and active):
+            return _DISABLED
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        if self.cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        yield
+        if self.cuda:
+            torch.cuda.synchronize()
+        self.times[name] += time.perf_counter() - start
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.times[name] += seconds
+
+    def pop(self):
+        '''
+        returns the seconds per stage since the last pop(). The time of the model's forward ('forward') not spent
+        in its stages is the loss computation, and is counted as 'loss'.
+        '''
+        times, self.times = self.times, defaultdict(float)
+        if 'forward' in times:
+            times['loss'] += times.pop('forward') - sum(times[name] for name in MODEL_STAGES)
+        return {name: times[name] for name in STAGES}
+
+
+class StageMetrics:
+    '''
+    Publishes the mean seconds per iteration of every stage of a StageTimer as engine.state.metrics['time_<stage>']
+    and appends them as a line of log_dir/stage_times.jsonl, every `every` iterations
+    '''
+
+    def __init__(self, timer, log_dir, every):
+        self.timer = timer
+        self.path = os.path.join(log_dir, 'stage_times.jsonl')
+        self.every = every
+        self._sums = defaultdict(float)
+        self._num_iterations = 0
+
+    def attach(self, engine):
+        engine.add_event_handler(Events.ITERATION_COMPLETED, self.update)
+
+    def update(self, engine):
+        for name, seconds in self.timer.pop().items():
+            self._sums[name] += seconds
+        self._num_iterations += 1
+        if engine.state.iteration % self.every == 0:
+            means = {name: self._sums[name] / self._num_iterations for name in STAGES}
+            engine.state.metrics.update({'time_' + name: seconds for name, seconds in means.items()})
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(iteration=engine.state.iteration, epoch=engine.state.epoch,
+                                        iterations=self._num_iterations, **means)) + '\n')
+            self._sums.clear()
+            self._num_iterations = 0
+
+
+class ProfilerWindow:
+    '''
+    torch.profiler over the iterations [start, start + num_iterations) of an engine, recording CPU (and CUDA) ops
+    with their input shapes and memory. At the end of the window it writes a Chrome trace (chrome://tracing,
+    Perfetto) and tables of the ops by time, by time and input shape, and by memory to log_dir, then turns off.
+    '''
+
+    def __init__(self, log_dir, start, num_iterations, device='cpu'):
+        self.log_dir = log_dir
+        self.start = start
+        self.end = start + num_iterations - 1
+        self.cuda = torch.device(device).type == 'cuda'
+        self._profiler = None
+
+    def attach(self, engine):
+        engine.add_event_handler(Events.ITERATION_STARTED(once=self.start), self._start)
+        engine.add_event_handler(Events.ITERATION_COMPLETED(once=self.end), self._stop)
+        engine.add_event_handler(Events.COMPLETED, self._stop)  # training ended inside the window
+
+    def _start(self, engine):
+        activities = [torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.cuda else [])
+        self._profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+        self._profiler.start()
+
+    def _stop(self, engine):
+        if self._profiler is None:
+            return
+        self._profiler.stop()
+        name = os.path.join(self.log_dir, 'profile_iterations_{}-{}'.format(self.start, engine.state.iteration))
+        self._profiler.export_chrome_trace(name + '.json')
+        sort_by = 'self_cuda_time_total' if self.cuda else 'self_cpu_time_total'
+        memory_sort_by = 'self_cuda_memory_usage' if self.cuda else 'self_cpu_memory_usage'
+        with open(name + '_ops.txt', 'w') as f:
+            f.write(self._profiler.key_averages().table(sort_by=sort_by, row_limit=50) + '\n\n')
+            f.write(self._profiler.key_averages(group_by_input_shape=True).table(sort_by=sort_by, row_limit=50) + '\n\n')
+            f.write(self._profiler.key_averages().table(sort_by=memory_sort_by, row_limit=30) + '\n')
+        print('Profile of iterations {}-{} written to {}.json and {}_ops.txt'.format(self.start, engine.state.iteration, name, name))
+        self._profiler = None
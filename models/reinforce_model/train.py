@@ -5,28 +5,34 @@ import random
 from pprint import pformat
 from argparse import ArgumentParser
 from collections import defaultdict
+from contextlib import nullcontext
 from itertools import chain
 from functools import partial
 from datetime import datetime
 
 import numpy as np
 import torch
-from apex import amp
 from torch.distributions import Categorical
 from torch.nn.parallel import DistributedDataParallel
-from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, TensorDataset
+from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
 from torch.utils.data.distributed import DistributedSampler
 from ignite.engine import Engine, Events
 from ignite.exceptions import NotComputableError
 from ignite.handlers import ModelCheckpoint
-from ignite.metrics import Accuracy, Loss, Metric, MetricsLambda, RunningAverage
+from ignite.metrics import Accuracy, Loss, Metric, MetricsLambda
 from ignite.metrics.metric import sync_all_reduce, reinit__is_reduced
 from ignite.contrib.handlers import ProgressBar, PiecewiseLinear
 from ignite.contrib.handlers.tensorboard_logger import TensorboardLogger, OutputHandler, OptimizerParamsHandler
 from transformers import (AdamW, OpenAIGPTDoubleHeadsModel, OpenAIGPTTokenizer,
                                   GPT2DoubleHeadsModel, GPT2Tokenizer, WEIGHTS_NAME, CONFIG_NAME)
 
-from models.reinforce_model.model_with_inferencenw import LatentVariableInferenceModel
+from models.reinforce_model.model_with_inferencenw import LatentVariableInferenceModel, select_personas
+from models.reinforce_model.activation_checkpointing import parse_submodules
+from models.reinforce_model.checkpointing import CHECKPOINT_MODES, PartialCheckpoint, base_reference
+from models.reinforce_model.distributed import init_distributed
+from models.reinforce_model.prefetch import DevicePrefetcher
+from models.reinforce_model.profiling import StageTimer, StageMetrics, ProfilerWindow
+from models.reinforce_model.training_state import ResumableSampler, TrainingStateCheckpoint, load_training_state, latest_training_state
 from models.reinforce_model.utils import get_dataset, make_logdir
 # from models.discrete_choice_model.data import get_data_loaders
 from models.reinforce_model.dataset import PersonaChatDataset, MAX_NUM_PERSONA, MAX_NUM_COMET_PERSONA
@@ -52,10 +58,14 @@ class Perplexity(Metric):
     @reinit__is_reduced
     def update(self, output):
         y_pred, _ = output
-        if y_pred.ndimension() != 2:
-            raise ValueError(f"Predictions (logits or probabilities has to have 2 dimensins. Got y_pred.shape={y_pred.shape}")
-        d = Categorical(None, y_pred, validate_args=self.validate_args)
-        ppl = d.perplexity()
+        if y_pred.ndimension() == 1:
+            # entropies of the predicted distributions, as given by the chunked cross-entropy
+            ppl = torch.exp(y_pred)
+        elif y_pred.ndimension() == 2:
+            d = Categorical(None, y_pred, validate_args=self.validate_args)
+            ppl = d.perplexity()
+        else:
+            raise ValueError(f"Predictions (logits or probabilities has to have 2 dimensins, entropies 1. Got y_pred.shape={y_pred.shape}")
         self._perplexities_sum += ppl.sum()
         self._num_distributions += ppl.numel()
 
@@ -67,6 +77,63 @@ class Perplexity(Metric):
         return ppl
 
 
+class DeviceRunningAverage:
+    '''
+    RunningAverage of several scalar outputs of an engine (tensors or Python numbers), kept on their device so that an
+    iteration does not wait for the host. The averages are read back (one sync for all of them) and published in
+    engine.state.metrics only every `log_every` iterations, at the first iteration and at the end of an epoch. In
+    distributed training they are averaged over the processes when published, as ignite's RunningAverage does, so
+    every process must attach it.
+    '''
+
+    def __init__(self, names, output_transform=lambda x: x, alpha=0.98, log_every=1):
+        self.names = names
+        self.output_transform = output_transform
+        self.alpha = alpha
+        self.log_every = log_every
+        self._value = None
+
+    def attach(self, engine):
+        engine.add_event_handler(Events.EPOCH_STARTED, self.reset)
+        engine.add_event_handler(Events.ITERATION_COMPLETED, self.update)
+        engine.add_event_handler(Events.EPOCH_COMPLETED, self.publish)
+
+    def reset(self, engine):
+        self._value = None
+
+    def update(self, engine):
+        value = torch.stack([torch.as_tensor(output).detach().float().reshape(()) for output in self.output_transform(engine.state.output)])
+        if self._value is None:
+            self._value = value
+            self.publish(engine)
+            return
+        self._value = self._value * self.alpha + (1.0 - self.alpha) * value
+        if engine.state.iteration % self.log_every == 0:
+            self.publish(engine)
+
+    def publish(self, engine):
+        if self._value is not None:
+            engine.state.metrics.update(zip(self.names, self.all_reduce_mean(self._value).tolist()))
+
+    @staticmethod
+    def all_reduce_mean(value):
+        if not (torch.distributed.is_available() and torch.distributed.is_initialized()):
+            return value
+        if torch.distributed.get_backend() == 'nccl':
+            value = value.to(torch.cuda.current_device())  # e.g. host scalars
+        value = value.clone()
+        torch.distributed.all_reduce(value)
+        return value / torch.distributed.get_world_size()
+
+
+PRECISION_DTYPES = {'fp32': torch.float32, 'fp16': torch.float16, 'bf16': torch.bfloat16}
+
+
+def autocast(precision, device):
+    ''' torch.autocast context of a --precision (fp32: disabled) on device '''
+    return torch.autocast(device_type=torch.device(device).type, dtype=PRECISION_DTYPES[precision], enabled=precision != 'fp32')
+
+
 def average_distributed_scalar(scalar, args):
     """ Average a scalar over the nodes if we are in distributed training. We use this for distributed evaluation. """
     if args.local_rank == -1:
@@ -97,6 +164,9 @@ python3 -m models.reinforce_model.train --dataset_path=/data2/bodhi/data/persona
 deep x 
 python3 -m models.reinforce_model.train --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --model_checkpoint=gpt2 --gradient_accumulation_steps=4 --lm_coef=2.0 --mc_coef=0.0 --max_history=2 --n_epochs=10 --num_candidates=1 --personality_permutations=1 --train_batch_size=2 --valid_batch_size=2 --do_train --training_type=reinforce --use_baseline --moving_avg_ratio=0.99 --reinforce_loss_coef=0.8 --lr=1e-4 --log_dir models/reinforce_model/ --exp_name EXP_NAME
 
+CPU data-parallel (gloo) on one host, 4 processes with a quarter of the cores each:
+torchrun --standalone --nproc_per_node=4 -m models.reinforce_model.train --device cpu --dataset_path=/data3/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --model_checkpoint=gpt2 --gradient_accumulation_steps=4 --lm_coef=2.0 --mc_coef=0.0 --max_history=2 --n_epochs=10 --num_candidates=1 --personality_permutations=1 --train_batch_size=2 --valid_batch_size=2 --do_train --training_type=reinforce --use_baseline --moving_avg_ratio=0.99 --reinforce_loss_coef=0.8 --lr=1e-4 --log_dir models/reinforce_model/ --exp_name EXP_NAME
+
 ==
 train w comet:
 > python3 train.py --dataset_path=/data2/bodhi/data/personachat/weak_label_comet_personachat/personachat_self_original_comet_scores_alignlabels.expanded_persona_preprocessed.json --model_checkpoint=gpt2 --gradient_accumulation_steps=4 --lm_coef=2.0 --max_history=2 --n_epochs=1 --num_candidates=4 --personality_permutations=2 --train_batch_size=1 --valid_batch_size=1 --test_run_num 5 --exp_name test --do_train --do_eval
@@ -107,6 +177,48 @@ train w comet:
 Structured Prior:
 --use_structured_prior -> to activate
 --effect_emb_dim <intval>
+
+Gradient checkpointing:
+--gradient_checkpointing gpt2,prior,posterior -> any subset; the blocks of these submodules keep only their inputs
+and recompute their activations in the backward pass. The loss and gradients do not change.
+
+submodule | kept per block instead of all its activations | extra cost                        | useful with
+gpt2      | its input: B x P x C x T x H                | one more GPT2 forward per step    | large batches, many candidates
+prior     | its input: B x P x T x H (persona rows)     | one more encoder forward per step | many COMET personas per example
+posterior | its input: B x P x T x H (persona rows)     | one more encoder forward per step | as prior; not run with marginalize
+(the BoW prior has no blocks)
+
+Measured peak memory and tokens/s for a given batch size:
+python3 -m models.reinforce_model.benchmark --mode grad_ckpt --train_batch_size=8 ...
+With --training_type marginalize the GPT2 chunks are already recomputed whole (--marginalize_chunk_size), so
+adding gpt2 only lowers the peak inside a chunk at the price of a second recomputation.
+
+Resumable training:
+--save_every 400 --keep_last 2 -> the full training state (weights, optimizer, lr schedule, loss scale, REINFORCE
+running mean, data order, RNG states) in LOG_DIR/training_states/ every 400 iterations, written in the background.
+--resume_from LOG_DIR/training_states (the latest) or a single file -> continues with the next iteration on the same
+data as the interrupted run, with the same arguments; the new run logs to a new directory. In distributed training
+every process restores the RNG states of the first one.
+
+Checkpoint modes (--checkpoint_mode):
+full      -> the state dict of the whole model every epoch
+trainable -> only the parameters with requires_grad (not the frozen heads, nor the inference network when
+             marginalizing) and a reference to the pretrained models / --model_checkpoint they start from
+delta     -> as trainable, and from the second epoch on the bitwise change since the previous epoch, compressed;
+             loading reads the whole chain of earlier epochs, so keep the run directory together
+generate.py and interact.py load all of them with --load_checkpoint_from; the base weights must be available.
+
+Stage timing:
+--time_stages_every 50 -> mean seconds per iteration of data_wait, h2d (the background copy), posterior, prior,
+sample (sampling / top-k and the gather of the chosen personas), gpt2, loss, backward, clip and optimizer, every
+50 iterations, as time_* metrics and as a line of LOG_DIR/stage_times.jsonl. On CUDA every stage synchronizes, so
+the step is slower than without; off, the stages cost a no-op context each.
+
+Profiling:
+--profile_from 200 --profile_iterations 5 -> torch.profiler over iterations 200-204 (ops, input shapes, memory),
+written to LOG_DIR/profile_iterations_200-204.json (open in chrome://tracing or ui.perfetto.dev) and
+LOG_DIR/profile_iterations_200-204_ops.txt; the profiler is off before and after. Start after the first
+iterations, which include warm-up. The baseline trainers take the same flags.
 '''
 
 def count_parameters(model):
@@ -137,8 +249,9 @@ def get_args():
     parser.add_argument("--personality_permutations", type=int, default=1, help="Number of permutations of personality sentences")
     parser.add_argument("--eval_before_start", action='store_true', help="If true start with a first evaluation before training")
     parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device (cuda or cpu)")
-    parser.add_argument("--fp16", type=str, default="", help="Set to O0, O1, O2 or O3 for fp16 training (see apex documentation)")
-    parser.add_argument("--local_rank", type=int, default=-1, help="Local rank for distributed training (-1: not distributed)")
+    parser.add_argument("--precision", type=str, default="fp32", choices=list(PRECISION_DTYPES), help="Autocast mixed precision of the forward pass (fp16 needs CUDA and uses loss scaling)")
+    parser.add_argument("--local_rank", type=int, default=int(os.environ.get("LOCAL_RANK", -1)), help="Local rank for distributed training (-1: not distributed, torchrun sets LOCAL_RANK)")
+    parser.add_argument("--num_threads_per_rank", type=int, default=0, help="Intra-op threads (and pinned cores) of every process in CPU distributed training (<=0: the cores split evenly)")
     parser.add_argument("--num_beams", type=int, default=5, help="Number of beams for comet expansion")
     parser.add_argument("--test_run_num", type=int, default=-1, help="Datapoints to run with in a test run")
     parser.add_argument("--exp_name", type=str, default="", required=True, help="Provide an experiment name")
@@ -148,7 +261,7 @@ def get_args():
     parser.add_argument("--no_comet_persona", action='store_true', help="No Persona Evaluation")
     parser.add_argument("--uniform_prior", action='store_true', help="Uniform prior")
     parser.add_argument("--entropy_regularize_prior_wt", type=float , default=0.0, help="entropy regularize prior")
-    parser.add_argument("--training_type", type=str, default="", help="Marginalize or Reinforce")
+    parser.add_argument("--training_type", type=str, default="", help="Marginalize, Reinforce or Topk")
     parser.add_argument("--use_baseline", action='store_true', help="Use baseline")
     parser.add_argument("--moving_avg_ratio", type=float, default=0.99, help="Moving avg ratio for running mean baseline")
     parser.add_argument("--reinforce_loss_coef", type=float, default=0.99, help="Loss coef for reinforce")
@@ -157,17 +270,40 @@ def get_args():
     parser.add_argument("--use_structured_prior", action='store_true', default=False, help="Use effect type as feature")
     parser.add_argument("--use_structured_prior_binarypotential", action='store_true', default=False, help="")
     parser.add_argument("--effect_emb_dim", type=int, default=6, help="Embedding type while computing effect feature")
+    parser.add_argument("--marginalize_chunk_size", type=int, default=4, help="Personas per GPT2 pass when marginalizing (<=0: all at once)")
+    parser.add_argument("--topk_personas", type=int, default=4, help="Personas the posterior picks to marginalize over with --training_type=topk")
+    parser.add_argument("--num_reinforce_samples", type=int, default=1, help="Personas sampled per example for reinforce; more than one uses a leave-one-out baseline")
+    parser.add_argument("--chunked_ce_size", type=int, default=0, help="Vocabulary entries per block of the chunked LM cross-entropy (<=0: full logits)")
+    parser.add_argument("--pack_length", type=int, default=0, help="Pack the GPT2 training sequences into rows of this many tokens (<=0: no packing)")
+    parser.add_argument("--gradient_checkpointing", type=str, default="", help="Comma separated submodules (gpt2, prior, posterior) whose transformer blocks recompute their activations in the backward pass")
+    parser.add_argument("--checkpoint_mode", type=str, default="full", choices=CHECKPOINT_MODES, help="Epoch checkpoints of the whole model, of the trainable parameters only, or of their compressed change since the previous epoch")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the order of the training data")
+    parser.add_argument("--save_every", type=int, default=0, help="Iterations between saves of the full training state, a multiple of --gradient_accumulation_steps (<=0: only the model, every epoch)")
+    parser.add_argument("--keep_last", type=int, default=2, help="Training states to keep on disk (<=0: all)")
+    parser.add_argument("--resume_from", type=str, default="", help="Training state file, or a directory of them (the latest), to continue training from")
+    parser.add_argument("--time_stages_every", type=int, default=0, help="Time the stages of the training steps and write their mean every this many iterations to stage_times.jsonl in the log dir (<=0: off; synchronizes CUDA around every stage)")
+    parser.add_argument("--profile_from", type=int, default=0, help="Iteration to start torch.profiler at; the trace and op tables go to the log dir (<=0: off)")
+    parser.add_argument("--profile_iterations", type=int, default=5, help="Iterations to profile from --profile_from")
+    parser.add_argument("--log_every", type=int, default=10, help="Iterations between reading the running averages of the training losses back from the device")
+    parser.add_argument("--dedup_personas", action='store_true', help="Encode identical persona rows of a batch only once")
+    parser.add_argument("--encoder_model", type=str, default="roberta-base", help="Encoder of the prior and posterior: HF name or local path with RoBERTa's vocabulary, or 'tiny' (random, for tests)")
+    parser.add_argument("--encoder_num_layers", type=int, default=0, help="Keep only the first layers of the encoder (<=0: all)")
+    parser.add_argument("--encoder_bucket_size", type=int, default=32, help="Rows per length-sorted bucket when encoding personas (<=0: one bucket)")
     args = parser.parse_args()
     if not args.do_train and args.do_eval:
         raise ValueError("You have to specify at least one of options `--do_train`, `--do_eval`")
+    parse_submodules(args.gradient_checkpointing)  # fail before loading anything
+    if args.save_every > 0 and args.save_every % args.gradient_accumulation_steps:
+        raise ValueError("--save_every must be a multiple of --gradient_accumulation_steps, accumulated gradients are not saved")
+    if args.precision == 'fp16' and torch.device(args.device).type != 'cuda':
+        raise ValueError("--precision fp16 needs a CUDA device, use bf16 on CPU")
     return args
 
 
 def create_evaluator(args, model):
     def inference(engine, batch):
         model.eval()
-        with torch.no_grad():
-            batch = {name: input_tensor.to(args.device) for name, input_tensor in batch.items()}
+        with torch.no_grad(), autocast(args.precision, args.device):
             lm_logits, mc_logits, *_ = model(
                 input_ids=batch["input_ids"],
                 token_type_ids=batch["token_type_ids"],
@@ -177,19 +313,36 @@ def create_evaluator(args, model):
                 persona=batch["persona"],
                 history=batch["history"],
                 effects=batch["effects"],
+                persona_length=batch["persona_length"],
+                history_length=batch["history_length"],
             )
-            lm_logits_flat_shifted = lm_logits[..., :-1, :].contiguous().view(-1, lm_logits.size(-1))
-            lm_labels_flat_shifted = batch["lm_labels"][:, 0, :, 1:].contiguous().view(-1)
-            return (lm_logits_flat_shifted, mc_logits), (lm_labels_flat_shifted, batch["mc_labels"])
+            if args.chunked_ce_size > 0:
+                # lm_logits are token statistics of the selected persona: (nll, entropy) at its labelled positions, NaN elsewhere
+                token_stats = lm_logits.view(-1, 2)
+                token_nll, token_entropy = token_stats[~torch.isnan(token_stats[:, 0])].unbind(-1)
+                return (token_nll, mc_logits, token_entropy), (token_nll, batch["mc_labels"])
+            # lm_logits are those of the first selected persona, whose reply is at its own positions
+            selected = getattr(model, 'module', model).selected_personas[:, :1]
+            lm_logits_flat_shifted = lm_logits[..., :-1, :].float().contiguous().view(-1, lm_logits.size(-1))
+            lm_labels_flat_shifted = select_personas(batch["lm_labels"], selected)[..., 1:].contiguous().view(-1)
+            return (lm_logits_flat_shifted, mc_logits.float()), (lm_labels_flat_shifted, batch["mc_labels"])
     
     evaluator = Engine(inference)
+    if args.chunked_ce_size > 0:
+        nll = Loss(lambda token_nll, _: token_nll.mean(), output_transform=lambda x: (x[0][0], x[1][0]))
+        ppl = Perplexity(output_transform=lambda x: (x[0][2], None))
+    else:
+        # as with the chunked statistics, only the labelled positions are averaged (and weigh a batch)
+        labelled = lambda x: x[1][0] != -100
+        nll = Loss(torch.nn.CrossEntropyLoss(), output_transform=lambda x: (x[0][0][labelled(x)], x[1][0][labelled(x)]))
+        ppl = Perplexity(output_transform=lambda x: (x[0][0][labelled(x)], None))
     metrics = {
-        "nll": Loss(torch.nn.CrossEntropyLoss(ignore_index=-100), output_transform=lambda x: (x[0][0], x[1][0])),
+        "nll": nll,
         # the accuracy is a filler since multiple-choice is not used.
         "accuracy": Accuracy(
             #output_transform=lambda x: (torch.argmax(x[0][1].view((-1,)), dim=0, keepdim=True), x[1][1][:, 0])),
             output_transform=lambda x: (torch.argmax(x[0][1].squeeze(1), dim=-1), x[1][1][:, 0])),
-        "ppl": Perplexity(output_transform=lambda x: (x[0][0], None)),
+        "ppl": ppl,
     }
 
     for name, metric in metrics.items():
@@ -202,50 +355,86 @@ def create_evaluator(args, model):
 
 
 def create_trainer_and_checkpoint_handler(args, model, optimizer, train_loader, val_loader, evaluator, log_dir):
+    # loss scaling keeps small fp16 gradients from flushing to zero; a no-op for fp32 and bf16
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16')
+    # the stages are timed on the main process only, which writes them
+    timer = StageTimer(args.time_stages_every > 0 and args.local_rank in [-1, 0], args.device)
+    getattr(model, 'module', model).stage_timer = timer
+
     def update(engine, batch):        
         model.train()
-        batch = {name: input_tensor.to(args.device) for name, input_tensor in batch.items()}
-        _, _, lm_loss, mc_loss, loss_prior, conditional_lm_loss, num_labels, track_rewards, kl_loss, elbo_loss_tracking = model(
-            input_ids=batch["input_ids"],
-            token_type_ids=batch["token_type_ids"],
-            mc_token_ids=batch["mc_token_ids"],
-            lm_labels=batch["lm_labels"],
-            mc_labels=batch["mc_labels"],
-            persona=batch["persona"],
-            history=batch["history"],
-            effects=batch["effects"],
-        )
-        loss = (lm_loss * args.lm_coef + mc_loss * args.mc_coef) / args.gradient_accumulation_steps
-        if args.fp16:
-            with amp.scale_loss(loss, optimizer) as scaled_loss:
-                scaled_loss.backward()
-            torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), args.max_norm)
-        else:
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_norm)
-        if engine.state.iteration % args.gradient_accumulation_steps == 0:
-            optimizer.step()
-            optimizer.zero_grad()
-        return loss.item(), lm_loss.item(), mc_loss.item(), loss_prior.item(), conditional_lm_loss.item(), track_rewards.item(), kl_loss.item(), elbo_loss_tracking.item()
+        timer.add('data_wait', train_loader.data_wait)
+        timer.add('h2d', train_loader.h2d)
+        optimizer_step = engine.state.iteration % args.gradient_accumulation_steps == 0
+        # DDP all-reduces the gradients only in the backward pass of the last accumulation step
+        with (model.no_sync() if args.local_rank != -1 and not optimizer_step else nullcontext()):
+            with autocast(args.precision, args.device), timer.stage('forward'):
+                _, _, lm_loss, mc_loss, loss_prior, conditional_lm_loss, num_labels, track_rewards, kl_loss, elbo_loss_tracking, reward_var, reward_stats = model(
+                    input_ids=batch["input_ids"],
+                    token_type_ids=batch["token_type_ids"],
+                    mc_token_ids=batch["mc_token_ids"],
+                    lm_labels=batch["lm_labels"],
+                    mc_labels=batch["mc_labels"],
+                    persona=batch["persona"],
+                    history=batch["history"],
+                    effects=batch["effects"],
+                    persona_length=batch["persona_length"],
+                    history_length=batch["history_length"],
+                )
+            with timer.stage('loss'):
+                loss = (lm_loss * args.lm_coef + mc_loss * args.mc_coef) / args.gradient_accumulation_steps
+            with timer.stage('backward'):
+                scaler.scale(loss).backward()
+        if optimizer_step:
+            # the scaled gradients can only be unscaled once per step, so they are clipped once, when complete
+            with timer.stage('clip'):
+                scaler.unscale_(optimizer)
+                torch.nn.utils.clip_grad_norm_(model.parameters(), args.max_norm)
+            with timer.stage('optimizer'):
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad()
+        # tensors, not .item(): DeviceRunningAverage reads them back only every args.log_every iterations
+        losses = (loss, lm_loss, mc_loss, loss_prior, conditional_lm_loss, track_rewards, kl_loss, elbo_loss_tracking, reward_var) + tuple(reward_stats)
+        dedup_ratio = getattr(getattr(model, 'module', model).prior_model, 'dedup_ratio', 0.0)
+        return tuple(output.detach() for output in losses) + (dedup_ratio, train_loader.data_wait)
     
     trainer = Engine(update)
+    # a different shuffle every epoch, the same on every process; a resumed epoch skips the batches already trained on
+    trainer.add_event_handler(Events.EPOCH_STARTED, lambda engine: train_loader.sampler.set_epoch(
+        engine.state.epoch, start=engine.state.iteration % engine.state.epoch_length * args.train_batch_size))
     scheduler = PiecewiseLinear(optimizer, "lr", [(0, args.lr), (args.n_epochs * len(train_loader), 0.0)])
     trainer.add_event_handler(Events.ITERATION_STARTED, scheduler)
-    RunningAverage(output_transform=lambda x: x[0]).attach(trainer, "loss")
-    RunningAverage(output_transform=lambda x: x[1]).attach(trainer, "lm_loss")
-    RunningAverage(output_transform=lambda x: x[2]).attach(trainer, "mc_loss")
-    RunningAverage(output_transform=lambda x: x[3]).attach(trainer, "prior_loss")
-    RunningAverage(output_transform=lambda x: x[4]).attach(trainer, "cond_lm_loss")
-    RunningAverage(output_transform=lambda x: x[5]).attach(trainer, "rewards")
-    RunningAverage(output_transform=lambda x: x[6]).attach(trainer, "kl_loss")
-    RunningAverage(output_transform=lambda x: x[7]).attach(trainer, "elbo_loss")
+    if args.resume_from:
+        resume_path = latest_training_state(args.resume_from)
+        iteration = load_training_state(resume_path, trainer, getattr(model, 'module', model), optimizer, scheduler, scaler,
+                                        train_loader.sampler, device=args.device)
+        if iteration >= args.n_epochs * len(train_loader):
+            raise ValueError("{} is already trained for {} epochs, increase --n_epochs to continue".format(resume_path, args.n_epochs))
+        print('Resuming from {} after iteration {}'.format(resume_path, iteration))
+    loss_names = ["loss", "lm_loss", "mc_loss", "prior_loss", "cond_lm_loss", "rewards", "kl_loss", "elbo_loss",
+                  "reward_var", "reward_std", "reward_min", "reward_max"]
+    DeviceRunningAverage(loss_names, output_transform=lambda x: x[:len(loss_names)], log_every=args.log_every).attach(trainer)
+    # host numbers, kept apart from the losses on the device; data_wait is the seconds the step waited for its batch
+    DeviceRunningAverage(["dedup_ratio", "data_wait"], output_transform=lambda x: x[-2:], log_every=args.log_every).attach(trainer)
+    if timer.enabled:
+        StageMetrics(timer, log_dir, args.time_stages_every).attach(trainer)
+    if args.profile_from > 0 and args.local_rank in [-1, 0]:
+        ProfilerWindow(log_dir, args.profile_from, args.profile_iterations, args.device).attach(trainer)
     if args.local_rank in [-1, 0]:
         pbar = ProgressBar(persist=True)
-        pbar.attach(trainer, metric_names=["loss", "lm_loss", "mc_loss", "prior_loss", "cond_lm_loss", "rewards", "kl_loss", "elbo_loss"])
-        checkpoint_handler = ModelCheckpoint(log_dir, 'checkpoint', save_interval=1, n_saved=None)
+        pbar.attach(trainer, metric_names=loss_names + ["dedup_ratio", "data_wait"])
         trainer.add_event_handler(Events.EPOCH_COMPLETED, lambda: print("Training complete. Saving Model."))
-        trainer.add_event_handler(Events.EPOCH_COMPLETED, checkpoint_handler, {'mymodel': getattr(model, 'module', model)})  # "getattr" takes care of distributed encapsulation
+        if args.checkpoint_mode == 'full':
+            checkpoint_handler = ModelCheckpoint(log_dir, 'checkpoint', save_interval=1, n_saved=None)
+            trainer.add_event_handler(Events.EPOCH_COMPLETED, checkpoint_handler, {'mymodel': getattr(model, 'module', model)})  # "getattr" takes care of distributed encapsulation
+        else:
+            checkpoint_handler = PartialCheckpoint(log_dir, 'checkpoint_mymodel', args.checkpoint_mode, base_reference(args))
+            trainer.add_event_handler(Events.EPOCH_COMPLETED, checkpoint_handler, getattr(model, 'module', model))
         trainer.add_event_handler(Events.EPOCH_COMPLETED, lambda: print("Model saved. Starting validation."))
+        if args.save_every > 0:
+            TrainingStateCheckpoint(os.path.join(log_dir, 'training_states'), args.save_every, args.keep_last,
+                                    getattr(model, 'module', model), optimizer, scheduler, scaler, train_loader.sampler).attach(trainer)
     else:
         checkpoint_handler = None
     if args.do_eval:
@@ -269,14 +458,16 @@ def create_model_and_optimizer(args, tokenizer):
         model_weights = torch.load(args.model_checkpoint, map_location=args.device)
         model.load_state_dict(model_weights)
     add_special_tokens_(model, tokenizer)
+    model.freeze_unused_parameters()
+    print('Trainable parameters: {}'.format(count_parameters(model)))
     if args.do_train:
-        optimizer = AdamW(model.parameters(), lr=args.lr, correct_bias=True)
+        optimizer = AdamW([p for p in model.parameters() if p.requires_grad], lr=args.lr, correct_bias=True)
     else:
         optimizer = None
-    if args.fp16 and args.do_train:
-        model, optimizer = amp.initialize(model, optimizer, opt_level=args.fp16)
     if args.local_rank != -1:
-        model = DistributedDataParallel(model, device_ids=[args.local_rank], output_device=args.local_rank, find_unused_parameters=True)
+        model = DistributedDataParallel(
+            model, device_ids=[args.local_rank] if args.device.type == 'cuda' else None,
+            output_device=args.local_rank if args.device.type == 'cuda' else None)
     return model, optimizer   
 
 
@@ -286,12 +477,6 @@ def create_tokenizer(args):
     return tokenizer
 
 
-def init_distributed(args):
-    torch.cuda.set_device(args.local_rank)
-    args.device = torch.device("cuda", args.local_rank)
-    torch.distributed.init_process_group(backend='nccl', init_method='env://')
-
-
 def create_val_dataloader(args, tokenizer):
     val_dataset = PersonaChatDataset(args, tokenizer, split='valid')
     if args.local_rank == -1:
@@ -306,15 +491,19 @@ def create_val_dataloader(args, tokenizer):
         pin_memory=True,
         sampler=val_sampler,
     )
-    return val_loader
+    return DevicePrefetcher(val_loader, args.device)
 
 
 def create_train_dataloader(args, tokenizer):
     train_dataset = PersonaChatDataset(args, tokenizer, split='train')
     if args.local_rank == -1:
-        train_sampler = RandomSampler(train_dataset)
+        train_sampler = ResumableSampler(train_dataset, seed=args.seed)
     else:
-        train_sampler = DistributedSampler(train_dataset)
+        train_sampler = ResumableSampler(train_dataset, seed=args.seed, num_replicas=torch.distributed.get_world_size(),
+                                         rank=torch.distributed.get_rank())
+    # the loader's own generator keeps it from drawing on the global RNG, whose state is saved with the training state
+    generator = torch.Generator()
+    generator.manual_seed(args.seed)
     train_loader = DataLoader(
         train_dataset,
         sampler=train_sampler,
@@ -322,8 +511,9 @@ def create_train_dataloader(args, tokenizer):
         collate_fn=partial(train_dataset.collate_dialog),
         pin_memory=True,
         worker_init_fn=seed_worker,
+        generator=generator,
     )
-    return train_loader
+    return DevicePrefetcher(train_loader, args.device, time_copies=args.time_stages_every > 0)
 
 
 def train():
@@ -369,8 +559,7 @@ def train():
         print('Running only Evaluation. No Training.')
         evaluator.run(val_loader)
     # On the main process: close tensorboard logger and rename the last checkpoint (for easy re-loading with OpenAIGPTModel.from_pretrained method)
-    if args.local_rank in [-1, 0] and args.n_epochs > 0 and args.do_train:
-        assert checkpoint_handler is not None
+    if args.local_rank in [-1, 0] and args.n_epochs > 0 and args.do_train and checkpoint_handler._saved:
         os.rename(os.path.join(log_dir, checkpoint_handler._saved[-1][1]), os.path.join(log_dir, WEIGHTS_NAME))  # TODO: PR in ignite to have better access to saved file paths (cleaner)
         # tb_logger.close()
 
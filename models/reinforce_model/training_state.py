@@ -0,0 +1,155 @@
+import os
+import math
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+from ignite.engine import Events
+
+STATE_PREFIX = 'training_state_'
+
+
+class ResumableSampler(Sampler):
+    '''
+    Shuffles the dataset with a generator seeded by (seed, epoch) instead of the global RNG, so the order of an
+    epoch can be produced again after a restart, and can start part way into it. With num_replicas > 1 every rank
+    takes its own slice of the same permutation, as DistributedSampler does.
+    '''
+
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = math.ceil(len(data_source) / num_replicas)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        ''' start: samples of this rank already consumed in the epoch '''
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=generator).tolist()
+        indices += indices[:self.num_samples * self.num_replicas - len(indices)]  # every rank gets as many
+        return iter(indices[self.rank::self.num_replicas][self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+def _to_cpu(obj):
+    ''' copy of the tensors of a (nested) state dict in host memory, which later training steps do not modify '''
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: _to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(value) for value in obj)
+    return obj
+
+
+def snapshot_training_state(engine, model, optimizer, scheduler, scaler, sampler):
+    '''
+    Everything needed to continue training after engine.state.iteration: the weights, the optimizer moments, the
+    position of the lr schedule, the loss scale, the REINFORCE baseline, the data order and the RNG states.
+    '''
+    return _to_cpu({
+        'engine': engine.state_dict(),
+        'model': model.state_dict(),
+        'running_mean': getattr(model, 'running_mean', None),
+        'optimizer': optimizer.state_dict(),
+        'scheduler': scheduler.state_dict(),
+        'scaler': scaler.state_dict(),
+        'sampler_seed': sampler.seed,
+        'rng': {
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else [],
+            'numpy': np.random.get_state(),
+            'random': random.getstate(),
+        },
+    })
+
+
+def load_training_state(path, engine, model, optimizer, scheduler, scaler, sampler, device='cpu'):
+    ''' Restores a snapshot_training_state() file; engine.run() then continues with the next iteration '''
+    state = torch.load(path, map_location='cpu')
+    engine.load_state_dict(state['engine'])
+    model.load_state_dict(state['model'])
+    if state['running_mean'] is not None:
+        model.running_mean = state['running_mean'].to(device)
+    optimizer.load_state_dict(state['optimizer'])
+    scheduler.load_state_dict(state['scheduler'])
+    scaler.load_state_dict(state['scaler'])
+    sampler.seed = state['sampler_seed']
+    torch.set_rng_state(state['rng']['torch'])
+    if state['rng']['cuda'] and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['rng']['cuda'])
+    np.random.set_state(state['rng']['numpy'])
+    random.setstate(state['rng']['random'])
+    return state['engine']['iteration']
+
+
+def saved_training_states(dirname):
+    ''' the training state files of dirname, oldest first '''
+    return sorted(os.path.join(dirname, name) for name in os.listdir(dirname)
+                  if name.startswith(STATE_PREFIX) and name.endswith('.pt'))
+
+
+def latest_training_state(path):
+    ''' path: a training state file, or a directory of them (the latest one is taken) '''
+    if not os.path.isdir(path):
+        return path
+    saved = saved_training_states(path)
+    if not saved:
+        raise ValueError('No training state in {}'.format(path))
+    return saved[-1]
+
+
+class TrainingStateCheckpoint:
+    '''
+    Saves the full training state every `save_every` iterations. The state is copied to host memory in the training
+    loop, the (slow) write to disk runs in a background thread while the next iterations train. Only the last
+    `keep_last` states are kept (<= 0: all).
+    '''
+
+    def __init__(self, dirname, save_every, keep_last, model, optimizer, scheduler, scaler, sampler):
+        self.dirname = dirname
+        self.save_every = save_every
+        self.keep_last = keep_last
+        self.objects = (model, optimizer, scheduler, scaler, sampler)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        os.makedirs(dirname, exist_ok=True)
+
+    def attach(self, engine):
+        engine.add_event_handler(Events.ITERATION_COMPLETED(every=self.save_every), self.save)
+        engine.add_event_handler(Events.COMPLETED, self.close)
+
+    def save(self, engine):
+        self.wait()  # at most one state in flight; raises the error of a failed write
+        state = snapshot_training_state(engine, *self.objects)
+        path = os.path.join(self.dirname, '{}{:09d}.pt'.format(STATE_PREFIX, engine.state.iteration))
+        self._pending = self._executor.submit(self._write, state, path)
+
+    def _write(self, state, path):
+        # a crash during the write leaves the previous states intact
+        torch.save(state, path + '.tmp')
+        os.replace(path + '.tmp', path)
+        if self.keep_last > 0:
+            for old_path in saved_training_states(self.dirname)[:-self.keep_last]:
+                os.remove(old_path)
+
+    def wait(self):
+        if self._pending is not None:
+            self._pending.result()
+            self._pending = None
+
+    def close(self, engine=None):
+        self.wait()
+        self._executor.shutdown()
@@ -0,0 +1,67 @@
+import os
+import sys
+from argparse import Namespace
+from types import SimpleNamespace
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2DoubleHeadsModel, RobertaConfig, RobertaForSequenceClassification
+
+from models.reinforce_model.checkpointing import PartialCheckpoint, base_reference, export, exported_path
+from models.reinforce_model.distill_prior import load_teacher
+from models.reinforce_model.model_with_inferencenw import LatentVariableInferenceModel
+
+
+@pytest.fixture
+def run_dir(tmp_path):
+    ''' a run directory of a small RoBERTa-prior model whose base weights are saved next to it '''
+    GPT2DoubleHeadsModel(GPT2Config(vocab_size=50262, n_embd=32, n_layer=2, n_head=2, n_positions=64)).save_pretrained(
+        str(tmp_path / 'gpt2'))
+    RobertaForSequenceClassification(RobertaConfig(
+        vocab_size=50265, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+        max_position_embeddings=80)).save_pretrained(str(tmp_path / 'roberta'))
+    args = Namespace(
+        generation_model=str(tmp_path / 'gpt2'), encoder_model=str(tmp_path / 'roberta'), encoder_num_layers=0,
+        model_checkpoint=None, prior_model='roberta', training_type='reinforce', uniform_prior=False,
+        entropy_regularize_prior_wt=0.0, use_structured_prior=False, use_structured_prior_binarypotential=False,
+        effect_emb_dim=6, device='cpu', use_baseline=True, moving_avg_ratio=0.99, reinforce_loss_coef=0.99)
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    torch.save(args, str(run_dir / 'model_training_args.bin'))
+    return run_dir, args
+
+
+def train_and_save(run_dir, args, mode):
+    ''' the model after two "epochs" of changes to its trainable parameters, saved with --checkpoint_mode mode '''
+    model = LatentVariableInferenceModel(args, generator_class=GPT2DoubleHeadsModel)
+    model.freeze_unused_parameters()
+    checkpoint = PartialCheckpoint(str(run_dir), 'checkpoint_mymodel', mode, base_reference(args))
+    for epoch in (1, 2):
+        with torch.no_grad():
+            for parameter in model.parameters():
+                if parameter.requires_grad:
+                    parameter.add_(1e-3 * torch.randn_like(parameter))
+        checkpoint(SimpleNamespace(state=SimpleNamespace(epoch=epoch)), model)
+    return model
+
+
+@pytest.mark.parametrize('mode', ['trainable', 'delta'])
+def test_export_and_distill_teacher(run_dir, mode, monkeypatch):
+    run_dir, args = run_dir
+    model = train_and_save(run_dir, args, mode)
+    monkeypatch.setattr(sys, 'argv', ['checkpointing', '--model_checkpoint_dir', str(run_dir),
+                                      '--load_checkpoint_from', 'checkpoint_mymodel_2.pth'])
+    export()
+    assert os.path.isdir(exported_path(str(run_dir / 'checkpoint_mymodel_2.pth')))
+
+    expected = model.prior_model.state_dict()
+    num_tokens = model.gpt2_model.get_input_embeddings().weight.shape[0]
+    for load_checkpoint_from in ('checkpoint_mymodel_2.pth', 'checkpoint_mymodel_2'):
+        teacher, _, model_weights = load_teacher(Namespace(
+            model_checkpoint_dir=str(run_dir), load_checkpoint_from=load_checkpoint_from, device='cpu'), num_tokens)
+        teacher_weights = teacher.state_dict()
+        assert teacher_weights.keys() == expected.keys()
+        for name, weight in expected.items():
+            assert torch.equal(teacher_weights[name], weight), name
+        for name, weight in model.gpt2_model.transformer.state_dict().items():
+            assert torch.equal(model_weights['gpt2_model.transformer.' + name], weight), name
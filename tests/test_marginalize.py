@@ -0,0 +1,76 @@
+from argparse import Namespace
+
+import pytest
+import torch
+from transformers import GPT2Config, GPT2DoubleHeadsModel, RobertaConfig, RobertaForSequenceClassification
+
+from models.reinforce_model.model_with_inferencenw import LatentVariableInferenceModel
+
+PAD = 50259
+
+
+@pytest.fixture
+def args(tmp_path):
+    ''' a marginalizing model with a small RoBERTa prior, without dropout so that training steps are deterministic '''
+    GPT2DoubleHeadsModel(GPT2Config(
+        vocab_size=50262, n_embd=32, n_layer=2, n_head=2, n_positions=64, resid_pdrop=0.0, embd_pdrop=0.0,
+        attn_pdrop=0.0, summary_first_dropout=0.0)).save_pretrained(str(tmp_path / 'gpt2'))
+    RobertaForSequenceClassification(RobertaConfig(
+        vocab_size=50265, hidden_size=32, num_hidden_layers=2, num_attention_heads=2, intermediate_size=64,
+        max_position_embeddings=80, hidden_dropout_prob=0.0, attention_probs_dropout_prob=0.0)).save_pretrained(
+        str(tmp_path / 'roberta'))
+    return Namespace(
+        generation_model=str(tmp_path / 'gpt2'), encoder_model=str(tmp_path / 'roberta'), encoder_num_layers=0,
+        model_checkpoint=None, prior_model='roberta', training_type='marginalize', uniform_prior=False,
+        entropy_regularize_prior_wt=0.0, use_structured_prior=False, use_structured_prior_binarypotential=False,
+        effect_emb_dim=6, device='cpu', use_baseline=False, moving_avg_ratio=0.99, reinforce_loss_coef=0.99)
+
+
+def make_batch(batch_size, num_personas, num_candidates, num_tokens=20, reply_length=4):
+    ''' personas of different lengths, so that the reply is at a different position for every persona '''
+    generator = torch.Generator().manual_seed(0)
+    shape = (batch_size, num_personas, num_candidates, num_tokens)
+    input_ids = torch.randint(3, 50000, shape, generator=generator)
+    token_type_ids = torch.full(shape, 50260)
+    lm_labels = torch.full(shape, -100)
+    lengths = torch.randint(num_tokens // 2, num_tokens + 1, shape[:3], generator=generator)
+    reply = torch.randint(3, 50000, (batch_size, num_candidates, reply_length), generator=generator)
+    for b in range(batch_size):
+        for p in range(num_personas):
+            for c in range(num_candidates):
+                length = int(lengths[b, p, c])
+                input_ids[b, p, c, length:] = PAD
+                input_ids[b, p, c, length - reply_length:length] = reply[b, c]
+            lm_labels[b, p, -1, lengths[b, p, -1] - reply_length:lengths[b, p, -1]] = reply[b, -1]
+    persona = torch.randint(3, 50000, (batch_size, num_personas, 8), generator=generator)
+    history = torch.randint(3, 50000, (batch_size, 10), generator=generator)
+    return dict(input_ids=input_ids, token_type_ids=token_type_ids, mc_token_ids=lengths - 1, lm_labels=lm_labels,
+                mc_labels=torch.zeros(batch_size, num_personas, dtype=torch.long), persona=persona, history=history,
+                effects=torch.zeros(batch_size, num_personas, dtype=torch.long))
+
+
+def loss_and_gradients(args, batch, chunk_size, training):
+    torch.manual_seed(0)
+    args.marginalize_chunk_size = chunk_size
+    model = LatentVariableInferenceModel(args, generator_class=GPT2DoubleHeadsModel)
+    model.freeze_unused_parameters()
+    model.train(training)
+    with torch.set_grad_enabled(training):
+        loss = model(**batch)[2]
+    if not training:
+        return loss, {}
+    loss.backward()
+    return loss, {name: parameter.grad for name, parameter in model.named_parameters() if parameter.grad is not None}
+
+
+@pytest.mark.parametrize('training', [True, False])
+@pytest.mark.parametrize('batch_size, num_personas, num_candidates, chunk_size', [(3, 3, 2, 2), (2, 3, 2, 1)])
+def test_chunked_marginalization(args, batch_size, num_personas, num_candidates, chunk_size, training):
+    ''' the last chunk holds a single persona (num_personas % chunk_size == 1) '''
+    batch = make_batch(batch_size, num_personas, num_candidates)
+    expected_loss, expected_gradients = loss_and_gradients(args, batch, 0, training)
+    loss, gradients = loss_and_gradients(args, batch, chunk_size, training)
+    assert torch.allclose(loss, expected_loss, atol=1e-5)
+    assert gradients.keys() == expected_gradients.keys()
+    for name, gradient in expected_gradients.items():
+        assert torch.allclose(gradients[name], gradient, atol=1e-5), name